@@ -1,29 +1,171 @@
-from flask import Blueprint, render_template, request, redirect, url_for, flash, session
+from flask import Blueprint, render_template, request, redirect, url_for, flash, session, g
 from datetime import datetime
 from firebase_admin import firestore, storage
-import uuid
+import hashlib
+import re
+
+from storage_batch import delete_blobs_batched
 
 blog_bp = Blueprint("blog", __name__, url_prefix="/blog")
 
+# 列表每頁文章數
+PAGE_SIZE = 50
+
+# 列表頁只需要的欄位（不抓整篇 HTML content）
+LIST_FIELDS = [
+    "title", "status", "categories", "category", "project",
+    "tags", "created_at", "created_by_name",
+]
+# 有關鍵字時才另外抓純文字內容做比對（列表頁本身不顯示內容）
+SEARCH_FIELDS = LIST_FIELDS + ["content_text"]
+
+# 允許上傳的圖片格式（以瀏覽器送來的 content type 判斷，不信任檔名）
+IMAGE_EXTENSIONS = {
+    "image/jpeg": "jpg",
+    "image/png": "png",
+    "image/webp": "webp",
+    "image/gif": "gif",
+}
+
+# 進度狀態（與 blog_form.html 的下拉選單一致）
+STATUSES = ("構想中", "進行中", "已完成", "暫停")
+
+# 文章內容裡上傳過的圖片路徑（upload_image 產生的 blog_images/<sha256>.<ext>，舊圖是 <uuid>）
+_BLOG_IMAGE_RE = re.compile(r"blog_images/[0-9A-Za-z_-]+\.[0-9A-Za-z]+")
+
+# 產生純文字內容時要換成空白的字元：換行與 <br> / <br/>
+_CONTENT_TEXT_RE = re.compile(r"\r|\n|<br\s*/?>", re.IGNORECASE)
+
+# 搜尋用 n-gram：中文關鍵字多半是兩個字，所以用 2-gram
+SEARCH_NGRAM_SIZE = 2
+SEARCH_NGRAM_LIMIT = 3000   # 單篇文章最多存幾個 n-gram（避免超過索引上限）
+
 
 # ========= Firestore 取用 =========
+_DB = None
+
+
 def get_db():
-    return firestore.client()
+    """第一次呼叫時取得 Firestore client，之後都重複使用同一個"""
+    global _DB
+    if _DB is None:
+        _DB = firestore.client()
+    return _DB
 
 
 def doc_to_dict(doc):
     d = doc.to_dict() or {}
     d["id"] = doc.id
+    # created_at / updated_at 是 Firestore Timestamp，轉成 ISO 字串給模板與分頁用
+    for k in ("created_at", "updated_at"):
+        if isinstance(d.get(k), datetime):
+            d[k] = d[k].isoformat()
     return d
 
 
+def parse_cursor(cursor):
+    """分頁 cursor（ISO 字串）轉回 datetime；舊資料的字串時間就原樣回傳"""
+    try:
+        return datetime.fromisoformat(cursor)
+    except ValueError:
+        return cursor
+
+
+def build_search_ngrams(title, content_text, tags, categories):
+    """
+    把標題 / 內容 / 標籤 / 分類轉成小寫 n-gram 清單，存在 search_ngrams 欄位，
+    列表搜尋時可以用 array_contains 先在 Firestore 篩出候選文章。
+    """
+    n = SEARCH_NGRAM_SIZE
+    grams = {}
+    # 標題、標籤、分類優先，內容最後，超過上限時先捨棄內容的 n-gram
+    for field in (title, tags, ", ".join(categories), content_text):
+        s = (field or "").lower()
+        for i in range(len(s) - n + 1):
+            grams[s[i:i + n]] = None
+            if len(grams) >= SEARCH_NGRAM_LIMIT:
+                return list(grams)
+    return list(grams)
+
+
+def extract_image_paths(content_html):
+    """找出文章內容用到的 blog_images/ 圖片路徑（存在 image_paths 欄位）"""
+    return sorted(set(_BLOG_IMAGE_RE.findall(content_html or "")))
+
+
+# 關鍵字比對的欄位，由便宜到昂貴排序（內文最長，放最後）
+# 分類用換行串起來，關鍵字不會跨兩個分類命中
+_KEYWORD_COLUMNS = (
+    lambda p: p.get("title", ""),
+    lambda p: p.get("tags", ""),
+    lambda p: "\n".join(p.get("categories") or []),
+    lambda p: p.get("content_text", ""),
+)
+
+
+def filter_posts_by_keyword(posts, q_lower):
+    """
+    關鍵字篩選：一次處理一個欄位，先把該欄抽成 list 再整欄比對，
+    已經命中的文章不再比下一欄，保持原本的順序回傳。
+    """
+    pending = list(range(len(posts)))
+    matched = set()
+    for column in _KEYWORD_COLUMNS:
+        values = [column(posts[i]).lower() for i in pending]
+        pending_next = []
+        for i, v in zip(pending, values):
+            if q_lower in v:
+                matched.add(i)
+            else:
+                pending_next.append(i)
+        pending = pending_next
+        if not pending:
+            break
+    return [p for i, p in enumerate(posts) if i in matched]
+
+
+# ========= 分類 =========
+# 分類彙整文件只有 1 份，每個 request 直接讀（不做跨 request 快取：
+# gunicorn 有多個 worker，各自的快取清不到別人，新分類會晚好幾分鐘才出現）
 def get_all_categories():
+    """取得所有分類（讀 meta/categories；同一個 request 內只取一次）"""
+    if "all_categories" in g:
+        return g.all_categories
+    g.all_categories = _fetch_all_categories()
+    return g.all_categories
+
+
+# ========= 分類彙整文件 meta/categories =========
+# 分類另外存在一份彙整文件，讀取時只要讀 1 份文件，不用掃描所有文章
+def get_categories_ref():
+    return get_db().collection("meta").document("categories")
+
+
+def _fetch_all_categories():
+    doc = get_categories_ref().get()
+    if doc.exists:
+        return sorted((doc.to_dict() or {}).get("names", []))
+
+    # 還沒有彙整文件（舊資料）：掃描一次並建立
+    return rebuild_categories_doc()
+
+
+def add_categories(batch, categories):
+    """在同一個 batch 裡，把文章用到的分類合併進彙整文件"""
+    if categories:
+        batch.set(
+            get_categories_ref(), {"names": firestore.ArrayUnion(categories)}, merge=True
+        )
+
+
+def rebuild_categories_doc():
     """
-    從所有文章中蒐集分類。
+    從所有文章重新蒐集分類並覆寫彙整文件。
     同時支援舊欄位 category（字串）與新欄位 categories（list）。
     """
     db = get_db()
-    docs = db.collection("blog_posts").stream()
+    # 只讀分類欄位，不用把每篇的 HTML 內容也傳回來
+    docs = db.collection("blog_posts").select(["category", "categories"]).stream()
     cat_set = set()
 
     for d in docs:
@@ -42,7 +184,9 @@ def get_all_categories():
             if c:
                 cat_set.add(c)
 
-    return sorted(cat_set)
+    names = sorted(cat_set)
+    get_categories_ref().set({"names": names})
+    return names
 
 
 # ========= 文章列表 =========
@@ -54,9 +198,38 @@ def blog_index():
     category = request.args.get("category", "").strip()
     status = request.args.get("status", "").strip()
     sort_by = request.args.get("sort_by", "created_at_desc")
+    cursor = request.args.get("cursor", "").strip()   # 上一頁最後一篇的 created_at
+
+    # 排序
+    if sort_by == "created_at_asc":
+        direction = firestore.Query.ASCENDING
+    else:
+        direction = firestore.Query.DESCENDING
+
+    # 進度 / 分類 / 排序直接交給 Firestore 查詢（走索引），只回傳符合的文章
+    qref = db.collection("blog_posts").select(SEARCH_FIELDS if q else LIST_FIELDS)
+    if status:
+        qref = qref.where("status", "==", status)
+    if category:
+        # 多分類：有其中一個就算
+        qref = qref.where("categories", "array_contains", category)
+    elif len(q) >= SEARCH_NGRAM_SIZE:
+        # Firestore 一個查詢只能有一個 array_contains：
+        # 沒有選分類時，用關鍵字的第一個 n-gram 先縮小範圍，下面再做完整比對
+        qref = qref.where(
+            "search_ngrams", "array_contains", q.lower()[:SEARCH_NGRAM_SIZE]
+        )
+    qref = qref.order_by("created_at", direction=direction)
+
+    # 分頁：從上一頁最後一篇之後開始，一次只讀 PAGE_SIZE 篇
+    if cursor:
+        qref = qref.start_after({"created_at": parse_cursor(cursor)})
+    qref = qref.limit(PAGE_SIZE)
+
+    posts = [doc_to_dict(d) for d in qref.stream()]
 
-    docs = db.collection("blog_posts").stream()
-    posts = [doc_to_dict(d) for d in docs]
+    # 這頁讀滿才可能還有下一頁（要在關鍵字篩選之前算）
+    next_cursor = posts[-1].get("created_at") if len(posts) == PAGE_SIZE else None
 
     # 先把舊欄位 category 轉成 categories list（只在程式裡用，不動資料庫）
     for p in posts:
@@ -66,40 +239,9 @@ def blog_index():
 
     # 🔍 關鍵字搜尋（標題 / 內容 / 標籤 / 分類）
     if q:
-        q_lower = q.lower()
-
-        def match(p):
-            cats_str = ", ".join(p.get("categories", [])).lower()
-            return (
-                q_lower in (p.get("title", "").lower())
-                or q_lower in (p.get("content_text", "").lower())
-                or q_lower in (p.get("tags", "").lower())
-                or q_lower in cats_str
-            )
-
-        posts = [p for p in posts if match(p)]
-
-    # 🔍 分類篩選（多分類：有其中一個就算）
-    if category:
-        posts = [
-            p for p in posts
-            if category in (p.get("categories") or [])
-        ]
-
-    # 🔍 進度狀態篩選
-    if status:
-        posts = [p for p in posts if p.get("status") == status]
-
-    # 排序
-    if sort_by == "created_at_asc":
-        reverse = False
-    else:
-        reverse = True
-
-    posts.sort(key=lambda x: x.get("created_at", ""), reverse=reverse)
+        posts = filter_posts_by_keyword(posts, q.lower())
 
     all_categories = get_all_categories()
-    all_statuses = sorted({p.get("status") for p in posts if p.get("status")})
 
     return render_template(
         "blog_list.html",
@@ -109,7 +251,9 @@ def blog_index():
         status=status,
         sort_by=sort_by,
         all_categories=all_categories,
-        all_statuses=all_statuses,
+        all_statuses=STATUSES,
+        cursor=cursor,
+        next_cursor=next_cursor,
     )
 
 
@@ -117,74 +261,70 @@ def blog_index():
 @blog_bp.route("/new", methods=["GET", "POST"])
 def blog_new():
     db = get_db()
-    all_categories = get_all_categories()
 
     if request.method == "POST":
         form = request.form
-        title = form.get("title", "").strip()
+        get = form.get
+        title = get("title", "").strip()
         if not title:
             flash("標題為必填", "danger")
             return render_template(
                 "blog_form.html",
                 post=form,
                 mode="new",
-                all_categories=all_categories,
+                all_categories=get_all_categories(),
             )
 
-        content_html = form.get("content", "").strip()
-        status = form.get("status", "").strip()
-        tags = form.get("tags", "").strip()
-        project = form.get("project", "").strip()
+        content_html = get("content", "").strip()
+        status = get("status", "").strip()
+        tags = get("tags", "").strip()
+        project = get("project", "").strip()
+        user_id = session.get("user_id")
+        user_name = session.get("user_name", "系統")
 
         # ✅ 已勾選的分類（右側 checkbox name="categories"）
         selected_categories = form.getlist("categories")
 
         # ✅ 新增分類（輸入框 name="new_categories"，逗號分隔）
-        new_categories_str = form.get("new_categories", "").strip()
+        new_categories_str = get("new_categories", "").strip()
         if new_categories_str:
             extra = [c.strip() for c in new_categories_str.split(",") if c.strip()]
             selected_categories.extend(extra)
 
-        # 去除重複 & 空白
-        categories = []
-        for c in selected_categories:
-            c = c.strip()
-            if c and c not in categories:
-                categories.append(c)
+        # 去除重複 & 空白（保留順序）
+        categories = list(dict.fromkeys(c.strip() for c in selected_categories if c and c.strip()))
 
         # 舊欄位：仍保留 primary category，方便之後需要
         primary_category = categories[0] if categories else ""
 
         # 純文字版內容（給搜尋用）
-        content_text = (
-            content_html.replace("\r", " ")
-            .replace("\n", " ")
-            .replace("<br>", " ")
-            .replace("<br/>", " ")
-        )
-
-        now = datetime.now().isoformat()
-        user_id = session.get("user_id")
-        user_name = session.get("user_name", "系統")
+        content_text = _CONTENT_TEXT_RE.sub(" ", content_html)
 
-        db.collection("blog_posts").add(
+        # 文章與分類彙整文件一起用 batch 寫入：一次來回、同時成功或失敗
+        batch = db.batch()
+        batch.set(
+            db.collection("blog_posts").document(),
             {
                 "title": title,
                 "content": content_html,
                 "content_text": content_text,
+                "search_ngrams": build_search_ngrams(title, content_text, tags, categories),
+                "image_paths": extract_image_paths(content_html),
                 "categories": categories,        # ⭐ 新欄位：list
                 "category": primary_category,    # ⭐ 舊欄位：單一字串（兼容）
                 "status": status,
                 "project": project,
                 "tags": tags,
-                "created_at": now,
+                "created_at": firestore.SERVER_TIMESTAMP,
                 "created_by_id": user_id,
                 "created_by_name": user_name,
-                "updated_at": now,
+                "updated_at": firestore.SERVER_TIMESTAMP,
                 "updated_by_id": user_id,
                 "updated_by_name": user_name,
-            }
+            },
         )
+        add_categories(batch, categories)
+        batch.commit()
 
         flash("已新增文章", "success")
         return redirect(url_for("blog.blog_index"))
@@ -193,7 +333,7 @@ def blog_new():
         "blog_form.html",
         post=None,
         mode="new",
-        all_categories=all_categories,
+        all_categories=get_all_categories(),
     )
 
 
@@ -233,20 +373,19 @@ def blog_edit(post_id):
         c = (post.get("category") or "").strip()
         post["categories"] = [c] if c else []
 
-    all_categories = get_all_categories()
-
     if request.method == "POST":
         form = request.form
-        title = form.get("title", "").strip()
+        get = form.get
+        title = get("title", "").strip()
         if not title:
             flash("標題為必填", "danger")
             post.update(
                 {
                     "title": title,
-                    "content": form.get("content", ""),
-                    "status": form.get("status", ""),
-                    "tags": form.get("tags", ""),
-                    "project": form.get("project", ""),
+                    "content": get("content", ""),
+                    "status": get("status", ""),
+                    "tags": get("tags", ""),
+                    "project": get("project", ""),
                     "categories": form.getlist("categories"),
                 }
             )
@@ -254,54 +393,48 @@ def blog_edit(post_id):
                 "blog_form.html",
                 post=post,
                 mode="edit",
-                all_categories=all_categories,
+                all_categories=get_all_categories(),
             )
 
-        content_html = form.get("content", "").strip()
-        status = form.get("status", "").strip()
-        tags = form.get("tags", "").strip()
-        project = form.get("project", "").strip()
+        content_html = get("content", "").strip()
+        status = get("status", "").strip()
+        tags = get("tags", "").strip()
+        project = get("project", "").strip()
+        user_id = session.get("user_id")
+        user_name = session.get("user_name", "系統")
 
         selected_categories = form.getlist("categories")
-        new_categories_str = form.get("new_categories", "").strip()
+        new_categories_str = get("new_categories", "").strip()
         if new_categories_str:
             extra = [c.strip() for c in new_categories_str.split(",") if c.strip()]
             selected_categories.extend(extra)
 
-        categories = []
-        for c in selected_categories:
-            c = c.strip()
-            if c and c not in categories:
-                categories.append(c)
+        categories = list(dict.fromkeys(c.strip() for c in selected_categories if c and c.strip()))
 
         primary_category = categories[0] if categories else ""
 
-        content_text = (
-            content_html.replace("\r", " ")
-            .replace("\n", " ")
-            .replace("<br>", " ")
-            .replace("<br/>", " ")
-        )
-
-        now = datetime.now().isoformat()
-        user_id = session.get("user_id")
-        user_name = session.get("user_name", "系統")
+        content_text = _CONTENT_TEXT_RE.sub(" ", content_html)
 
         updated = {
             "title": title,
             "content": content_html,
             "content_text": content_text,
+            "search_ngrams": build_search_ngrams(title, content_text, tags, categories),
+            "image_paths": extract_image_paths(content_html),
             "categories": categories,
             "category": primary_category,
             "status": status,
             "tags": tags,
             "project": project,
-            "updated_at": now,
+            "updated_at": firestore.SERVER_TIMESTAMP,
             "updated_by_id": user_id,
             "updated_by_name": user_name,
         }
 
-        doc_ref.update(updated)
+        batch = db.batch()
+        batch.update(doc_ref, updated)
+        add_categories(batch, categories)
+        batch.commit()
         flash("已更新文章", "success")
         return redirect(url_for("blog.blog_detail", post_id=post_id))
 
@@ -309,15 +442,50 @@ def blog_edit(post_id):
         "blog_form.html",
         post=post,
         mode="edit",
-        all_categories=all_categories,
+        all_categories=get_all_categories(),
     )
 
 
 # ========= 刪除文章 =========
+def delete_unused_images(db, content_html):
+    """
+    刪掉文章裡上傳過、而且沒有其他文章在用的圖片，避免 Storage 留下孤兒檔案。
+    圖片以內容雜湊命名，同一張圖可能被其他文章共用，那些就不能刪
+    """
+    image_paths = set(extract_image_paths(content_html))
+    if image_paths:
+        paths = sorted(image_paths)
+        for i in range(0, len(paths), 30):   # array_contains_any 一次最多 30 個值
+            others = (
+                db.collection("blog_posts")
+                .where("image_paths", "array_contains_any", paths[i:i + 30])
+                .select(["image_paths"])
+                .stream()
+            )
+            for d in others:
+                image_paths -= set((d.to_dict() or {}).get("image_paths") or [])
+
+    if image_paths:
+        delete_blobs_batched(storage.bucket(), sorted(image_paths))
+
+
 @blog_bp.route("/<post_id>/delete", methods=["POST"])
 def blog_delete(post_id):
     db = get_db()
-    db.collection("blog_posts").document(post_id).delete()
+    doc_ref = db.collection("blog_posts").document(post_id)
+    doc = doc_ref.get()
+    content_html = (doc.to_dict() or {}).get("content", "") if doc.exists else ""
+    doc_ref.delete()
+
+    # 刪除很少發生，這時候才重新整理分類，把沒人用的分類拿掉
+    rebuild_categories_doc()
+
+    # 文章已經刪了：圖片清不掉只記 log，不要讓使用者看到錯誤頁
+    try:
+        delete_unused_images(db, content_html)
+    except Exception as e:
+        print("⚠️ 刪除文章圖片發生錯誤：", e)
+
     flash("已刪除文章", "info")
     return redirect(url_for("blog.blog_index"))
 
@@ -328,23 +496,85 @@ def upload_image():
     if not file:
         return {"error": "沒有收到圖片"}, 400
 
+    # 副檔名依 content type 決定，不信任使用者的檔名
+    ext = IMAGE_EXTENSIONS.get(file.content_type)
+    if not ext:
+        return {"error": "不支援的圖片格式"}, 400
+
     # 取得預設 bucket（就是你在 initialize_app 設的 team-me-98acf.firebasestorage.app）
     bucket = storage.bucket()
 
-    # 產生唯一檔名，放在 blog_images/ 底下
-    ext = file.filename.rsplit(".", 1)[-1].lower()
-    filename = f"blog_images/{uuid.uuid4()}.{ext}"
+    # 以內容的 SHA-256 當檔名，放在 blog_images/ 底下：同一張圖重複上傳只會存一份
+    data = file.read()
+    digest = hashlib.sha256(data).hexdigest()
+    filename = f"blog_images/{digest}.{ext}"
 
     blob = bucket.blob(filename)
-    blob.upload_from_string(
-        file.read(),
-        content_type=file.content_type
-    )
-
-    # 設定為公開讀取（任何人可看圖片）
-    blob.make_public()
+    if not blob.exists():
+        # 檔名就是內容雜湊，內容不會變：讓瀏覽器 / CDN 長期快取
+        blob.cache_control = "public, max-age=31536000, immutable"
+        # 圖片已經整個在記憶體裡，一次傳完不走 resumable 分段
+        blob.upload_from_string(data, content_type=file.content_type)
 
+    # bucket 已在部署時設定 allUsers 可讀（objectViewer），不用再逐檔 make_public()
     # 這個網址就可以直接給 <img src="...">
-    image_url = blob.public_url
+    image_url = f"https://storage.googleapis.com/{bucket.name}/{filename}"
 
     return {"url": image_url}
+
+
+# ========= CLI：重建搜尋索引 =========
+@blog_bp.cli.command("reindex")
+def reindex_cmd():
+    """
+    幫舊文章補上 categories / search_ngrams / image_paths 欄位：
+      flask --app team_me_firebase.py blog reindex
+    """
+    db = get_db()
+    count = 0
+    for d in db.collection("blog_posts").stream():
+        p = d.to_dict() or {}
+        cats = p.get("categories")
+        if not isinstance(cats, list):
+            c = (p.get("category") or "").strip()
+            cats = [c] if c else []
+        d.reference.update(
+            {
+                # 舊文章只有 category 字串，補上 categories list，列表的分類篩選才找得到
+                "categories": cats,
+                "search_ngrams": build_search_ngrams(
+                    p.get("title", ""), p.get("content_text", ""), p.get("tags", ""), cats
+                ),
+                "image_paths": extract_image_paths(p.get("content", "")),
+            }
+        )
+        count += 1
+
+    print(f"已更新 {count} 篇文章的搜尋索引")
+
+
+# ========= CLI：時間欄位轉成 Timestamp =========
+@blog_bp.cli.command("migrate-timestamps")
+def migrate_timestamps_cmd():
+    """
+    把舊文章字串格式的 created_at / updated_at 轉成 Firestore Timestamp，
+    讓列表的 order_by("created_at") 排序正確：
+      flask --app team_me_firebase.py blog migrate-timestamps
+    """
+    db = get_db()
+    count = 0
+    for d in db.collection("blog_posts").stream():
+        p = d.to_dict() or {}
+        updates = {}
+        for k in ("created_at", "updated_at"):
+            v = p.get(k)
+            if isinstance(v, str) and v:
+                try:
+                    updates[k] = datetime.fromisoformat(v)
+                except ValueError:
+                    print(f"⚠️ 無法解析 {d.id} 的 {k}：{v}")
+        if updates:
+            d.reference.update(updates)
+            count += 1
+
+    print(f"已轉換 {count} 篇文章的時間欄位")
@@ -0,0 +1,31 @@
+# ========= Storage 批次刪除 =========
+# 主程式（買方 / 賣方圖片）和 blog（文章圖片）共用
+
+# Storage batch API 一次最多打包 100 個操作
+STORAGE_BATCH_SIZE = 100
+
+
+def delete_blobs_batched(bucket, paths: list) -> bool:
+    """
+    用 client.batch() 把刪除打包成一個 HTTP 請求（最多 100 個一包）。
+    raise_exception=False 時個別檔案失敗不會丟錯，所以要自己看每一筆的回應：
+    2xx 或 404（已經不在了）才算成功；403 / 429 / 5xx 等回傳 False，之後再重試
+    """
+    ok = True
+    for i in range(0, len(paths), STORAGE_BATCH_SIZE):
+        chunk = paths[i:i + STORAGE_BATCH_SIZE]
+        batch = bucket.client.batch(raise_exception=False)
+        with batch:
+            for blob_path in chunk:
+                bucket.blob(blob_path).delete()
+        # finish() 後每個子請求的回應依序放在 _responses
+        failed = [
+            r.status_code for r in batch._responses
+            if not (200 <= r.status_code < 300 or r.status_code == 404)
+        ]
+        if failed or len(batch._responses) != len(chunk):
+            print(f"⚠️ 刪除 Storage 檔案部分失敗：{bucket.name}，狀態碼 {failed}")
+            ok = False
+        else:
+            print(f"🔥 已刪除 Storage 檔案 {len(chunk)} 個：{bucket.name}")
+    return ok
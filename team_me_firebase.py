@@ -1,23 +1,67 @@
 from flask import (
     Flask, render_template, request, redirect,
-    url_for, flash, session, Response, Blueprint
+    url_for, flash, session, Response, Blueprint, stream_with_context, jsonify
 )
 import os
-import json
-from datetime import datetime
+import re
+import subprocess
+try:
+    import orjson as _json   # 比標準 json 快，解析憑證用
+except ImportError:
+    import json as _json
+from datetime import datetime, timedelta, timezone
 import csv
-from io import StringIO, BytesIO
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+import queue
+import threading
+import time
+from io import BytesIO
 from uuid import uuid4
+from typing import Iterable, Iterator, Optional
 from PIL import Image
 
 import firebase_admin
 from firebase_admin import credentials, firestore, storage  
-from werkzeug.security import generate_password_hash, check_password_hash
-from urllib.parse import urlparse, unquote
+from google.api_core.exceptions import AlreadyExists, NotFound
+from werkzeug.security import check_password_hash
+from werkzeug.datastructures import FileStorage
+from werkzeug.middleware.proxy_fix import ProxyFix
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerificationError
+from urllib.parse import unquote
+from cachetools import TTLCache
+
+from storage_batch import delete_blobs_batched
 
 
 print("Working directory:", os.getcwd())
 
+# ========= gevent worker =========
+# gunicorn 用 gevent worker 時 socket 已經被 monkey patch，Firestore 的 gRPC 也要切到 gevent，
+# 等 Firestore / Storage 回應時才會讓出給其他 request，而不是卡住整個 worker
+try:
+    from gevent import monkey as _gevent_monkey
+except ImportError:
+    _gevent_monkey = None
+_GEVENT = _gevent_monkey is not None and _gevent_monkey.is_module_patched("socket")
+if _GEVENT:
+    from grpc.experimental import gevent as _grpc_gevent
+    _grpc_gevent.init_gevent()
+
+
+def run_cpu_bound(func, *args, **kwargs):
+    """
+    CPU 重的工作（縮圖、密碼雜湊）用這個呼叫。
+    gevent 下 threading 也被 patch 成 greenlet，直接跑會卡住整個 worker 的所有 request；
+    這時丟到 gevent hub 的原生執行緒池（Pillow / argon2 計算時會放開 GIL）。沒有 gevent 就直接跑
+    """
+    if _GEVENT:
+        from gevent import get_hub
+        return get_hub().threadpool.apply(func, args, kwargs)
+    return func(*args, **kwargs)
+
 # ========= Firestore + Storage 初始化（Render + 本機皆可用） =========
 def init_firebase():
     """
@@ -35,7 +79,7 @@ def init_firebase():
     cred_json = os.environ.get("FIREBASE_CREDENTIALS")
     if cred_json:
         try:
-            cred_dict = json.loads(cred_json)
+            cred_dict = _json.loads(cred_json)
             cred = credentials.Certificate(cred_dict)
             print("✅ 使用 FIREBASE_CREDENTIALS 初始化 Firebase")
         except Exception as e:
@@ -57,16 +101,87 @@ def init_firebase():
     return firestore.client()
 
 
-# 全域 Firestore client
+# 全域 Firestore client：整個 process 共用一個（gRPC channel 可同時給多個 thread 使用），
+# blog 的 get_db() 拿到的也是同一個，不要在 request 裡另外建立 client
 db = init_firebase()
 
+# 共用的 I/O 執行緒池：同一個 request 裡互不相依的 Firestore / Storage 呼叫丟進來同時跑，
+# 不用每個 request 重新開執行緒（丟進來的工作不要再把工作丟回同一個池子，避免互等卡死）
+IO_POOL = ThreadPoolExecutor(max_workers=16, thread_name_prefix="io")
+
+# ========= Storage bucket =========
+@lru_cache(maxsize=8)
+def _get_bucket(name: Optional[str] = None):
+    """bucket 物件建立一次就重複使用；name 是 None 表示預設 bucket"""
+    return storage.bucket(name) if name else storage.bucket()
+
+
 # ========= 圖片上傳相關設定 =========
 ALLOWED_IMAGE_EXTENSIONS = {"jpg", "jpeg", "png", "gif", "webp"}
 
-def allowed_image(filename: str) -> bool:
-    if not filename:
-        return False
-    return "." in filename and filename.rsplit(".", 1)[1].lower() in ALLOWED_IMAGE_EXTENSIONS
+# IMAGE_POSTPROCESS=1 時，改用 mozjpeg（cjpeg）/ oxipng 壓縮，檔案通常小 30~50%
+# 主機上沒裝這些工具、或壓縮失敗，就直接用 Pillow 的結果
+IMAGE_POSTPROCESS = os.environ.get("IMAGE_POSTPROCESS") == "1"
+POSTPROCESS_COMMANDS = {
+    # cjpeg 吃的是 Pillow 輸出的 PPM（無損），只做一次有損壓縮，不會 Pillow 壓過再壓一次
+    "JPEG": ["cjpeg", "-quality", "82", "-optimize", "-progressive"],
+    # PNG 本來就無損，oxipng 只是重新最佳化
+    "PNG": ["oxipng", "-o", "2", "--stdout", "-"],
+}
+# 交給壓縮工具時 Pillow 先輸出的格式
+POSTPROCESS_INPUT_FORMATS = {"JPEG": "PPM", "PNG": "PNG"}
+
+
+def postprocess_image(data: bytes, save_format: str) -> Optional[bytes]:
+    """用外部工具壓縮；工具不能用或失敗回傳 None"""
+    try:
+        result = subprocess.run(POSTPROCESS_COMMANDS[save_format], input=data, capture_output=True, timeout=30)
+    except (OSError, subprocess.TimeoutExpired) as e:
+        print("⚠️ 圖片壓縮工具無法執行：", e)
+        return None
+    if result.returncode != 0 or not result.stdout:
+        return None
+    return result.stdout
+
+
+# 小於這個大小、寬度也沒超過的 JPEG / WebP 不重新壓縮，原檔直接上傳
+SMALL_IMAGE_BYTES = 200 * 1024
+
+
+def resize_image(img, save_format: str, max_width: int) -> bytes:
+    """解碼 → 等比例縮到寬度不超過 max_width → 重新壓縮，回傳檔案內容"""
+    # JPEG 可以在解碼時直接縮小（1/2、1/4、1/8），大照片省時間也省記憶體；
+    # 其他格式 draft() 不做事
+    w, h = img.size
+    if w > max_width:
+        img.draft("RGB", (max_width, int(h * max_width / w)))
+
+    # 只有需要時才轉色彩模式（轉換會整張複製一次）：
+    # JPEG 沒有透明度一律 RGB；PNG / WebP / GIF 有透明度就保留成 RGBA
+    has_alpha = img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info)
+    target_mode = "RGBA" if has_alpha and save_format != "JPEG" else "RGB"
+    if img.mode != target_mode:
+        img = img.convert(target_mode)
+
+    # 等比例縮到寬度不超過 max_width（本來就比較小的話 thumbnail 不會動）
+    img.thumbnail((max_width, 65536), Image.LANCZOS)
+
+    # （選用）交給 mozjpeg / oxipng 壓縮
+    if IMAGE_POSTPROCESS and save_format in POSTPROCESS_COMMANDS:
+        buf = BytesIO()
+        img.save(buf, format=POSTPROCESS_INPUT_FORMATS[save_format])
+        source = buf.getvalue()
+        data = postprocess_image(source, save_format)
+        if data is not None and (save_format != "PNG" or len(data) < len(source)):
+            return data
+        if save_format == "PNG":
+            # oxipng 沒有比較小：Pillow 的 PNG 就能用，不用再存一次
+            return source
+
+    # 存到記憶體 buffer
+    buf = BytesIO()
+    img.save(buf, format=save_format, quality=85)
+    return buf.getvalue()
 
 
 def upload_image_to_storage(file, folder: str, object_id: str, max_width: int = 1080):
@@ -91,58 +206,147 @@ def upload_image_to_storage(file, folder: str, object_id: str, max_width: int =
         print("❌ 不支援的圖片格式：", ext)
         return None
 
-    bucket = storage.bucket()
+    bucket = _get_bucket()
 
-    # 用 uuid 避免檔名互相覆蓋，例如：sellers/<id>_<uuid>.jpg
-    unique_suffix = uuid4().hex[:8]
+    # 用完整 uuid（128 bit）避免檔名互相覆蓋，例如：sellers/<id>_<uuid>.jpg
+    unique_suffix = uuid4().hex
     blob_path = f"{folder}/{object_id}_{unique_suffix}.{ext}"
     blob = bucket.blob(blob_path)
 
-    # 1️⃣ 用 Pillow 讀入圖片
-    img = Image.open(file.stream)
-    img = img.convert("RGB")   # 避免有 alpha 造成問題
-
-    # 2️⃣ 如果寬度超過 max_width，就等比例縮小
-    w, h = img.size
-    if w > max_width:
-        new_h = int(h * max_width / w)
-        img = img.resize((max_width, new_h), Image.LANCZOS)
-
-    # 3️⃣ 存到記憶體 buffer
-    buf = BytesIO()
     save_format = "JPEG" if ext in ["jpg", "jpeg"] else ext.upper()
-    img.save(buf, format=save_format, quality=85)
-    buf.seek(0)  # 🔑 重點：讓 stream 從開頭開始
 
-    # 4️⃣ 上傳至 Firebase Storage
+    # 1️⃣ 用 Pillow 讀入圖片（只讀檔頭，還沒解碼）
+    stream = file.stream
+    stream.seek(0, 2)
+    file_size = stream.tell()
+    stream.seek(0)
+    img = Image.open(stream)
+
+    if (
+        file_size <= SMALL_IMAGE_BYTES
+        and save_format in ("JPEG", "WEBP")
+        and img.format == save_format      # 副檔名跟實際格式一致才原檔上傳
+        and img.width <= max_width
+        and img.mode in ("RGB", "L")
+        and "exif" not in img.info         # 手機照片的 EXIF 可能有 GPS 位置，要重新壓縮拿掉
+        and "xmp" not in img.info
+    ):
+        # 已經夠小、沒有中繼資料的 JPEG / WebP 直接上傳原檔，不用解碼、縮圖再重新壓縮
+        stream.seek(0)
+        data = stream.read()
+    else:
+        data = run_cpu_bound(resize_image, img, save_format, max_width)
+
+    # 2️⃣ 上傳至 Firebase Storage
     content_type = file.mimetype or "image/jpeg"
-    blob.upload_from_file(buf, content_type=content_type)
-    blob.make_public()
+    blob.upload_from_string(data, content_type=content_type)
 
+    # bucket 已設定 allUsers:objectViewer，不用再對每個檔案 make_public()（省一次往返）；
+    # public_url 是本地組出來的 https://storage.googleapis.com/<bucket>/<path>
     print("✅ 上傳圖片完成：", blob.public_url)
     return blob.public_url
 
 
+def upload_images_to_storage(files, folder: str, object_id: str) -> list:
+    """
+    多張圖片同時上傳：每張都是一次獨立的 HTTPS 上傳（等網路為主），用執行緒並行
+    回傳上傳成功的網址，順序跟表單選的一樣；某一張失敗（壞檔、Storage 錯誤）只略過那一張
+    """
+    files = [f for f in files if f and f.filename]
+    futures = [
+        IO_POOL.submit(upload_image_to_storage, f, folder=folder, object_id=object_id)
+        for f in files
+    ]
+    urls = []
+    for f, future in zip(files, futures):
+        try:
+            url = future.result()
+        except Exception as e:
+            print(f"⚠️ 圖片上傳失敗（{f.filename}）：", e)
+            continue
+        if url:
+            urls.append(url)
+    return urls
+
+
+# ========= 背景上傳圖片 =========
+# 縮圖 + 上傳 Storage 交給背景執行緒，使用者不用等圖片處理完；
+# 文件上的 pending_photos 記還有幾張在處理，做完再把網址補進 photo_urls
+def read_uploads(files) -> list:
+    """request 結束後上傳檔案的 stream 就關了，先把內容讀進記憶體"""
+    return [
+        FileStorage(stream=BytesIO(f.read()), filename=f.filename, content_type=f.mimetype)
+        for f in files
+        if f and f.filename
+    ]
+
+
+@firestore.transactional
+def _append_photo_urls(transaction, doc_ref, urls: list) -> bool:
+    snap = doc_ref.get(transaction=transaction)
+    if not snap.exists:
+        return False
+    data = snap.to_dict() or {}
+    # 舊資料只有 photo_url，先把它放進列表，才不會被新圖蓋掉
+    photos = data.get("photo_urls") or ([data["photo_url"]] if data.get("photo_url") else [])
+    photos = photos + [url for url in urls if url not in photos]
+    transaction.update(doc_ref, {
+        "photo_urls": photos,
+        "photo_url": photos[0] if photos else "",   # 第一張給舊版用
+    })
+    return True
+
+
+def start_background_upload(uploads: list, collection_name: str, object_id: str) -> None:
+    if not uploads:
+        return
+    doc_ref = db.collection(collection_name).document(object_id)
+
+    def work():
+        urls = []
+        try:
+            # 個別失敗的圖片已經略過，成功的照樣補進 photo_urls
+            urls = upload_images_to_storage(uploads, folder=collection_name, object_id=object_id)
+            if urls and not _append_photo_urls(db.transaction(), doc_ref, urls):
+                # 上傳期間文件被刪掉了，圖片也不要留
+                delete_storage_files(urls)
+        except Exception as e:
+            print("⚠️ 背景上傳圖片失敗：", e)
+            # 網址沒寫進文件，檔案留著也沒人用
+            delete_storage_files(urls)
+        finally:
+            # 不管成功失敗，這批都處理完了
+            try:
+                doc_ref.update({"pending_photos": firestore.Increment(-len(uploads))})
+            except NotFound:
+                pass
+            except Exception as e:
+                print("⚠️ 更新 pending_photos 失敗：", e)
+
+    threading.Thread(target=work, daemon=True).start()
+
+
 def delete_image_from_storage(folder: str, object_id: str):
     """
     刪除 Firebase Storage 裡這個 buyer/seller 的圖片
     - folder: "buyers" / "sellers"
     - object_id: Firestore 文件 id
-    這裡會嘗試所有常見副檔名，有存在就刪掉。
+    用檔名前綴 <folder>/<object_id> 一次列出，再用 Storage batch 打包刪除：
+    <id>_<uuid>.<ext>（目前的命名）和舊版的 <id>.<ext> 都算，
+    但不會誤刪 id 剛好以這個 id 開頭的其他文件的圖
     """
+    prefix = f"{folder}/{object_id}"
     try:
-        bucket = storage.bucket()
-        for ext in ALLOWED_IMAGE_EXTENSIONS:
-            blob_path = f"{folder}/{object_id}.{ext}"
-            blob = bucket.blob(blob_path)
-            # 避免亂砍，先檢查有沒有存在
-            if blob.exists():
-                blob.delete()
-                print("🗑️ 已刪除圖片：", blob_path)
+        bucket = _get_bucket()
+        paths = [
+            b.name for b in bucket.list_blobs(prefix=prefix)
+            if b.name[len(prefix):len(prefix) + 1] in ("_", ".")
+        ]
+        # 別人已經刪掉的檔案（404）不算失敗
+        if paths and delete_blobs_batched(bucket, paths):
+            print(f"🗑️ 已刪除 {len(paths)} 張圖片：{folder}/{object_id}")
     except Exception as e:
         print("⚠️ 刪除圖片時發生錯誤：", e)
-        
-
 
 
 # ========= Flask 基本設定 =========
@@ -154,29 +358,350 @@ BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 from blog import blog_bp
 app.register_blueprint(blog_bp)
 
+# 前面有幾層 proxy（例如平台的 router）：只信任這幾層加上的 X-Forwarded-For，
+# 使用者自己送的 X-Forwarded-For 不會被當成來源 IP。直接對外時設成 0
+PROXY_COUNT = int(os.environ.get("PROXY_COUNT", "1"))
+if PROXY_COUNT:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=PROXY_COUNT)
+
 # 限制單一請求最大 5MB（可依需求調整）
 app.config["MAX_CONTENT_LENGTH"] = 5 * 1024 * 1024
 
+# 正式環境不檢查模板檔有沒有改過（FLASK_DEBUG=1 開發時才自動重新載入）
+app.config["TEMPLATES_AUTO_RELOAD"] = os.environ.get("FLASK_DEBUG") == "1"
+app.jinja_env.auto_reload = app.config["TEMPLATES_AUTO_RELOAD"]
+
+# 啟動時先把所有模板編譯進 Jinja 快取，第一次開頁面不用等編譯
+for _template_name in app.jinja_env.list_templates(extensions=["html"]):
+    app.jinja_env.get_template(_template_name)
+
 # ========= 小工具 =========
-def doc_to_dict(doc):
+def doc_to_dict(doc) -> dict:
     """把 Firestore Document 轉成 dict 並加上 id 欄位"""
     data = doc.to_dict()
     data["id"] = doc.id
+    # created_at / updated_at 是 Firestore Timestamp，轉成 ISO 字串給模板與 CSV 用
+    for k in ("created_at", "updated_at"):
+        if isinstance(data.get(k), datetime):
+            data[k] = data[k].isoformat()
     return data
 
 
-def delete_by_field(collection_name, field_name, field_value):
+def is_plain_doc_id(value) -> bool:
+    """可以直接當 Firestore 文件 id 的字串：不含 "/"、不是 . / ..、不是 __xxx__ 保留字"""
+    return (
+        isinstance(value, str)
+        and 0 < len(value.encode("utf-8")) <= 1500
+        and "/" not in value
+        and value not in (".", "..")
+        and not (value.startswith("__") and value.endswith("__"))
+    )
+
+
+def get_followups_ref(parent_collection, parent_id):
     """
-    把 collection_name 中 field_name == field_value 的文件全部刪掉
-    用來刪掉某個客戶底下所有追蹤紀錄
+    某位買方 / 賣方底下的追蹤紀錄（subcollection）：
+    buyers/<buyer_id>/followups、sellers/<seller_id>/followups
     """
-    ref = db.collection(collection_name).where(field_name, "==", field_value)
-    docs = list(ref.stream())
-    for d in docs:
-        d.reference.delete()
+    return db.collection(parent_collection).document(parent_id).collection("followups")
+
+
+# 詳細頁一次顯示的追蹤紀錄筆數
+FOLLOWUP_PAGE_SIZE = 50
+
+
+def query_followups_page(parent_collection, parent_id, after: str) -> list:
+    """
+    詳細頁的一批追蹤紀錄：依 contact_time 新到舊。
+    after 是上一批最後一筆的文件 id：contact_time 只到分鐘，用時間當 cursor 會漏掉同一分鐘的其他筆；
+    用文件快照當 cursor，Firestore 會再依文件 id 排序，每一筆都只出現一次
+    """
+    followups_ref = get_followups_ref(parent_collection, parent_id)
+    query = followups_ref.order_by("contact_time", direction=firestore.Query.DESCENDING)
+    if after and is_plain_doc_id(after):
+        cursor_doc = followups_ref.document(after).get()
+        if cursor_doc.exists:
+            query = query.start_after(cursor_doc)
+    return list(query.limit(FOLLOWUP_PAGE_SIZE).stream())
+
+
+# ========= 建立者 / 編輯者欄位 =========
+def _audit_fields(verb: str) -> dict:
+    """{verb}_at（伺服器時間）、{verb}_by_id、{verb}_by_name，verb 是 "created" 或 "updated" """
+    return {
+        f"{verb}_at": firestore.SERVER_TIMESTAMP,
+        f"{verb}_by_id": session.get("user_id"),
+        f"{verb}_by_name": session.get("user_name"),
+    }
+
+
+# ========= 編輯紀錄（audit） =========
+def build_audit_diff(before: dict, updated: dict) -> dict:
+    """
+    比對編輯前後的欄位，只留下真的有變動的：{欄位: {"from": 舊值, "to": 新值}}
+    updated_at / updated_by_* 這類每次都會變的欄位、以及衍生的 search_tokens / pending_photos 不列入
+    """
+    diff = {}
+    for key, new_value in updated.items():
+        if key.startswith("updated_") or key in ("search_tokens", "pending_photos"):
+            continue
+        old_value = before.get(key)
+        if old_value != new_value:
+            diff[key] = {"from": old_value, "to": new_value}
+    return diff
+
+
+def add_audit_record(batch, audit_collection, parent_field, parent_id, diff):
+    """把一筆編輯紀錄加進 batch，跟主文件的更新一起 commit"""
+    batch.set(db.collection(audit_collection).document(), {
+        parent_field: parent_id,
+        "diff": diff,
+        "at": firestore.SERVER_TIMESTAMP,
+        "by": session.get("user_id"),
+        "by_name": session.get("user_name"),
+    })
+
+
+# ========= 表單欄位 =========
+# 買方表單的文字欄位（新增 / 編輯共用同一份清單）
+BUYER_FIELDS = (
+    "name", "phone", "email", "line_id", "source", "level", "intent_type",
+    "rent_min", "rent_max", "budget_min", "budget_max",
+    "preferred_areas", "property_type", "room_range", "car_need",
+    "job", "family_info", "requirement_must", "requirement_nice",
+    "other_background", "note",
+    "stage",                 # 接觸 / 帶看 / 斡旋 / 成交
+)
+
+
+# 賣方表單的文字欄位（新增 / 編輯共用同一份清單）
+SELLER_FIELDS = (
+    "name", "phone", "email", "line_id", "address", "property_type",
+    "level",
+    "stage",                 # 開發中 / 委託中 / 成交
+    "reason", "expected_price", "min_price", "timeline", "occupancy_status",
+    "contract_end_date",     # 委託到期日
+    "note",
+    "source",                # 客源來源
+)
+
+
+def _collect(form, fields: tuple) -> dict:
+    """一次取出表單欄位並去掉前後空白，沒填的給空字串"""
+    return {k: form.get(k, "").strip() for k in fields}
+
+
+# ========= 列表查詢 =========
+# 列表每頁筆數（?page_size= 可調，但限制在 1 ~ MAX_PAGE_SIZE）
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+
+def parse_page_size(raw: str) -> int:
+    try:
+        size = int(raw)
+    except (TypeError, ValueError):
+        return PAGE_SIZE
+    return max(1, min(size, MAX_PAGE_SIZE))
+
+# 列表頁只需要的欄位（備註、需求等長文字欄位留給詳細頁 / 編輯頁）
+BUYER_LIST_FIELDS = [
+    "name", "phone", "level", "intent_type", "stage", "source",
+    "created_at", "created_by_name",
+]
+SELLER_LIST_FIELDS = [
+    "name", "phone", "level", "stage", "source", "contract_end_date",
+    "address", "created_at", "created_by_name",
+]
+
+# sort_by → (排序欄位, 方向)
+SORT_OPTIONS = {
+    "created_at_desc": ("created_at", firestore.Query.DESCENDING),
+    "created_at_asc": ("created_at", firestore.Query.ASCENDING),
+    "name_asc": ("name", firestore.Query.ASCENDING),
+    "name_desc": ("name", firestore.Query.DESCENDING),
+}
+
+
+def _load_source_options(collection_name: str) -> list:
+    """從現有資料整理出「不重複的來源」做成下拉選單用（只讀 source 欄位）"""
+    source_set = set()
+    for d in db.collection(collection_name).select(["source"]).stream():
+        s = ((d.to_dict() or {}).get("source") or "").strip()
+        if s:
+            source_set.add(s)
+    return sorted(source_set)
+
+
+# ========= 姓名 / 電話搜尋 =========
+# search_tokens：姓名（轉小寫）與電話（只留數字）的 1~3 字片段，
+# 列表搜尋用 array_contains 走索引，不用整個 collection 掃過再比對
+# （片段長度改過之後要跑一次 reindex-search）
+SEARCH_TOKEN_SIZES = (1, 2, 3)
+SEARCH_SCAN_LIMIT = 2000  # 關鍵字比片段長時，最多讀幾筆候選資料再精確比對
+_NON_DIGIT_RE = re.compile(r"\D")
+_PHONE_LIKE_RE = re.compile(r"[\d\s\-+()]+")
+
 
+def build_search_tokens(name: str, phone: str) -> list:
+    tokens = set()
+    for text in ((name or "").lower(), _NON_DIGIT_RE.sub("", phone or "")):
+        for n in SEARCH_TOKEN_SIZES:
+            tokens.update(text[i:i + n] for i in range(len(text) - n + 1))
+    return sorted(tokens)
 
 
+def normalize_search_text(q: str) -> str:
+    """關鍵字正規化：看起來像電話就只留數字，其他轉小寫"""
+    if _PHONE_LIKE_RE.fullmatch(q):
+        return _NON_DIGIT_RE.sub("", q)
+    return q.lower()
+
+
+def matches_search(item: dict, text: str) -> bool:
+    return (
+        text in (item.get("name") or "").lower()
+        or text in _NON_DIGIT_RE.sub("", item.get("phone") or "")
+    )
+
+
+def apply_search(query, text: str) -> tuple:
+    """
+    用關鍵字的一個片段 array_contains 縮小範圍（走索引）。
+    關鍵字比片段長時用最後 3 個字：電話幾乎都是 09 開頭，開頭的片段幾乎每筆都符合。
+    回傳 (query, 是否還需要再精確比對一次)
+    """
+    if not text:
+        return query, False
+    seed = text[-max(SEARCH_TOKEN_SIZES):]
+    query = query.where("search_tokens", "array_contains", seed)
+    return query, len(text) > len(seed)
+
+
+# ========= 來源選單快取 =========
+# 來源下拉選單要掃整個 collection 的 source 欄位，短時間內重新整理直接用上次的結果。
+# 快取是每個 gunicorn worker 各自一份，清快取也只清自己這個 worker：
+# 別的 worker 最多 30 秒後才看到新的來源，所以只拿來放選單，列表資料不快取
+SOURCE_OPTIONS_TTL = 30  # 秒
+_source_options_cache = TTLCache(maxsize=8, ttl=SOURCE_OPTIONS_TTL)
+_source_options_lock = threading.Lock()
+
+
+def get_source_options(collection_name: str) -> list:
+    with _source_options_lock:
+        value = _source_options_cache.get(collection_name)
+    if value is None:
+        value = _load_source_options(collection_name)
+        with _source_options_lock:
+            _source_options_cache[collection_name] = value
+    return value
+
+
+def invalidate_source_options(collection_name: str) -> None:
+    with _source_options_lock:
+        _source_options_cache.pop(collection_name, None)
+
+
+# ========= 列表查詢：買方 / 賣方共用 =========
+class InvalidCursor(ValueError):
+    """分頁 cursor 不能當文件 id，或那一筆已經不在了（被刪掉、網址被改過）"""
+
+
+def query_list_page(collection_name: str, fields: list, filters: tuple,
+                    q: str, sort_by: str, cursor: str, page_size: int = PAGE_SIZE) -> tuple:
+    """
+    列表頁的查詢流程（買方 / 賣方都一樣）：
+    完全比對的篩選 + 關鍵字片段都交給 Firestore（走索引），排序也是，
+    再從 cursor 之後讀一頁。回傳 (這一頁的資料, 下一頁 cursor, 總筆數, 搜尋結果是否過多被截斷)
+    """
+    if cursor and not is_plain_doc_id(cursor):
+        raise InvalidCursor(cursor)
+
+    query = db.collection(collection_name).select(fields)
+    for field, value in filters:
+        if value:
+            query = query.where(field, "==", value)
+
+    # ⭐ 關鍵字（姓名 / 電話）：用 search_tokens 走索引
+    search_text = normalize_search_text(q)
+    query, recheck = apply_search(query, search_text)
+    order_field, direction = SORT_OPTIONS.get(sort_by, SORT_OPTIONS["created_at_desc"])
+
+    if recheck:
+        return _search_list_page(query, search_text, order_field, direction, cursor, page_size)
+
+    # ===== 總筆數：count() 聚合查詢，只回傳數字不讀文件 =====
+    count_query = query.count()
+
+    # ===== 排序（也交給 Firestore） =====
+    query = query.order_by(order_field, direction=direction)
+
+    # ===== 分頁：從上一頁最後一筆之後開始，一次只讀 page_size 筆 =====
+    # 總筆數跟這一頁的查詢互不相依，同時送出
+    f_total = IO_POOL.submit(count_query.get)
+
+    if cursor:
+        cursor_doc = db.collection(collection_name).document(cursor).get()
+        if not cursor_doc.exists:
+            raise InvalidCursor(cursor)
+        query = query.start_after(cursor_doc)
+
+    docs = list(query.limit(page_size).stream())
+    total = f_total.result()[0][0].value
+    next_cursor = docs[-1].id if len(docs) == page_size else None
+    return [doc_to_dict(d) for d in docs], next_cursor, total, False
+
+
+def _search_list_page(query, search_text: str, order_field: str, direction: str,
+                      cursor: str, page_size: int) -> tuple:
+    """
+    關鍵字比片段長：片段只能縮小範圍，符合片段的候選資料（依列表的排序，最多 SEARCH_SCAN_LIMIT 筆）
+    讀進來精確比對再分頁，這樣每一頁都是滿的，總筆數也是真正符合的筆數。
+    候選資料超過上限時只看得到排序在前面的那些，回傳 truncated=True 讓頁面提示縮小搜尋
+    """
+    docs = list(query.order_by(order_field, direction=direction).limit(SEARCH_SCAN_LIMIT).stream())
+    truncated = len(docs) == SEARCH_SCAN_LIMIT
+    items = [item for item in map(doc_to_dict, docs) if matches_search(item, search_text)]
+
+    start = 0
+    if cursor:
+        start = next((i + 1 for i, item in enumerate(items) if item["id"] == cursor), None)
+        if start is None:
+            raise InvalidCursor(cursor)
+    page = items[start:start + page_size]
+    next_cursor = page[-1]["id"] if start + page_size < len(items) else None
+    return page, next_cursor, len(items), truncated
+
+
+
+# ========= 密碼雜湊 =========
+# argon2（C 實作）：新密碼一律用 argon2；舊帳號的 werkzeug pbkdf2 雜湊仍可登入，
+# 登入成功時順便改存成 argon2
+password_hasher = PasswordHasher(time_cost=2, memory_cost=19456, parallelism=1)
+
+
+def hash_password(password):
+    return run_cpu_bound(password_hasher.hash, password)
+
+
+def verify_password(user_ref, user, password):
+    """驗證密碼；舊格式或舊參數的雜湊驗證成功時會改寫成目前的 argon2 設定"""
+    pwd_hash = user.get("password_hash", "")
+
+    if pwd_hash.startswith("$argon2"):
+        try:
+            run_cpu_bound(password_hasher.verify, pwd_hash, password)
+        except (VerificationError, InvalidHashError):
+            return False
+        # 之後調整 argon2 參數時，舊參數的雜湊在登入成功時改存成新參數
+        if password_hasher.check_needs_rehash(pwd_hash):
+            user_ref.update({"password_hash": hash_password(password)})
+        return True
+
+    if run_cpu_bound(check_password_hash, pwd_hash, password):
+        user_ref.update({"password_hash": hash_password(password)})
+        return True
+    return False
 
 
 # ========= 登入保護 =========
@@ -194,9 +719,69 @@ def login_required(view_func):
 
 
 # ========= 登入 / 登出 =========
+def get_user_doc(email):
+    """
+    用 email 找使用者：新帳號的文件 id 就是 email，直接讀一份文件即可。
+    找不到時再用 email 欄位查詢（舊帳號是自動產生的 id）。
+    email 不能當文件 id 時（含 "/"、"."、"__xxx__" 這類保留字），直接改用查詢
+    """
+    if is_plain_doc_id(email):
+        user_doc = db.collection("users").document(email).get()
+        if user_doc.exists:
+            return user_doc
+
+    users_ref = db.collection("users").where("email", "==", email).limit(1)
+    return next(iter(users_ref.stream()), None)
+
+
+# ========= 登入防暴力嘗試 =========
+# 查無此帳號的 email 記 60 秒，重複亂試不用每次都查 Firestore；
+# 同一個 IP 一分鐘內失敗太多次就直接擋掉，連 Firestore 跟密碼雜湊都不用跑
+LOGIN_FAIL_LIMIT = 10
+LOGIN_FAIL_WINDOW = 60  # 秒
+NEG_CACHE = TTLCache(maxsize=10_000, ttl=60)
+_login_failures = TTLCache(maxsize=10_000, ttl=LOGIN_FAIL_WINDOW)  # ip → (次數, 第一次失敗時間)
+_login_lock = threading.Lock()
+
+
+def client_ip() -> str:
+    # X-Forwarded-For 使用者可以自己填，只信 ProxyFix 依 PROXY_COUNT 換算過的 remote_addr
+    return request.remote_addr or ""
+
+
+def is_negative_cached(email: str) -> bool:
+    with _login_lock:
+        return NEG_CACHE.get(email, False)
+
+
+def cache_negative(email: str) -> None:
+    with _login_lock:
+        NEG_CACHE[email] = True
+
+
+def too_many_login_failures(ip: str) -> bool:
+    with _login_lock:
+        count, started = _login_failures.get(ip, (0, 0))
+        return count >= LOGIN_FAIL_LIMIT and time.monotonic() - started < LOGIN_FAIL_WINDOW
+
+
+def record_login_failure(ip: str) -> None:
+    now = time.monotonic()
+    with _login_lock:
+        count, started = _login_failures.get(ip, (0, now))
+        if now - started >= LOGIN_FAIL_WINDOW:
+            count, started = 0, now
+        _login_failures[ip] = (count + 1, started)
+
+
 @app.route("/login", methods=["GET", "POST"])
 def login():
     if request.method == "POST":
+        ip = client_ip()
+        if too_many_login_failures(ip):
+            flash("登入失敗次數過多，請稍後再試", "danger")
+            return render_template("login.html"), 429
+
         email = request.form.get("email", "").strip().lower()
         password = request.form.get("password", "")
 
@@ -204,20 +789,28 @@ def login():
             flash("請輸入帳號與密碼", "danger")
             return redirect(url_for("login"))
 
-        users_ref = db.collection("users").where("email", "==", email).limit(1)
-        docs = list(users_ref.stream())
+        if is_negative_cached(email):
+            record_login_failure(ip)
+            flash("帳號或密碼錯誤", "danger")
+            return redirect(url_for("login"))
 
-        if not docs:
+        user_doc = get_user_doc(email)
+        if user_doc is None:
+            cache_negative(email)
+            record_login_failure(ip)
             flash("帳號或密碼錯誤", "danger")
             return redirect(url_for("login"))
 
-        user_doc = docs[0]
         user = user_doc.to_dict()
 
-        if not check_password_hash(user.get("password_hash", ""), password):
+        if not verify_password(user_doc.reference, user, password):
+            record_login_failure(ip)
             flash("帳號或密碼錯誤", "danger")
             return redirect(url_for("login"))
 
+        with _login_lock:
+            _login_failures.pop(ip, None)
+
         session["user_id"] = user_doc.id
         session["user_name"] = user.get("name") or user.get("email")
         session["user_email"] = user.get("email")
@@ -255,62 +848,29 @@ def buyers():
     stage = request.args.get("stage", "").strip()          # 進程：接觸 / 帶看 / 斡旋 / 成交
     source = request.args.get("source", "").strip()        # 客源來源（下拉選單選到的值）
     sort_by = request.args.get("sort_by", "created_at_desc")
+    cursor = request.args.get("cursor", "").strip()       # 上一頁最後一筆的 id
+    page_size = parse_page_size(request.args.get("page_size"))
+
+    # ⭐ 等級 / 需求類型 / 進程 / 來源都是完全比對，直接交給 Firestore 查詢（走索引）
+    filters = (
+        ("level", level),
+        ("intent_type", intent_type),
+        ("stage", stage),
+        ("source", source),          # 從下拉選單選出來的值，完全比對
+    )
+    try:
+        buyers_list, next_cursor, total, truncated = query_list_page(
+            "buyers", BUYER_LIST_FIELDS, filters, q, sort_by, cursor, page_size
+        )
+    except InvalidCursor:
+        # 分頁資訊失效：其他條件不變，明確回到第一頁
+        flash("分頁資訊已失效，已回到第一頁", "warning")
+        args = request.args.to_dict()
+        args.pop("cursor", None)
+        return redirect(url_for("buyers", **args))
 
-    # 先抓全部買方
-    docs = db.collection("buyers").stream()
-    all_buyers = [doc_to_dict(d) for d in docs]
-
-    # ⭐ 從現有資料裡整理出「不重複的來源」做成下拉選單用
-    source_set = set()
-    for b in all_buyers:
-        s = (b.get("source") or "").strip()
-        if s:
-            source_set.add(s)
-    source_options = sorted(source_set)   # 給模板用的清單
-
-    # 實際要被篩選 / 顯示的列表
-    buyers_list = list(all_buyers)
-
-    # ===== 篩選條件 =====
-
-    # 1️⃣ 關鍵字搜尋（姓名 / 電話）
-    if q:
-        buyers_list = [
-            b for b in buyers_list
-            if q in (b.get("name") or "") or q in (b.get("phone") or "")
-        ]
-
-    # 2️⃣ 客戶等級
-    if level:
-        buyers_list = [b for b in buyers_list if b.get("level") == level]
-
-    # 3️⃣ 需求類型
-    if intent_type:
-        buyers_list = [b for b in buyers_list if b.get("intent_type") == intent_type]
-
-    # 4️⃣ 進程
-    if stage:
-        buyers_list = [b for b in buyers_list if b.get("stage") == stage]
-
-    # 5️⃣ 客源來源（這裡是「完全比對」，因為是從下拉選單選出來的值）
-    if source:
-        buyers_list = [b for b in buyers_list if (b.get("source") or "") == source]
-
-    # ===== 排序 =====
-    def parse_created_at(b):
-        v = b.get("created_at")
-        if not v:
-            return ""
-        return v  # 你現在都是 isoformat 字串，直接拿來比大小就好
-
-    if sort_by == "created_at_asc":
-        buyers_list.sort(key=parse_created_at)
-    elif sort_by == "created_at_desc":
-        buyers_list.sort(key=parse_created_at, reverse=True)
-    elif sort_by == "name_asc":
-        buyers_list.sort(key=lambda b: (b.get("name") or ""))
-    elif sort_by == "name_desc":
-        buyers_list.sort(key=lambda b: (b.get("name") or ""), reverse=True)
+    # ⭐ 來源下拉選單
+    source_options = get_source_options("buyers")
 
     return render_template(
         "buyers.html",
@@ -322,6 +882,11 @@ def buyers():
         source=source,                # 目前選到的來源
         source_options=source_options,  # ⭐ 給前端畫下拉選單
         sort_by=sort_by,
+        cursor=cursor,
+        next_cursor=next_cursor,
+        total=total,
+        truncated=truncated,          # 搜尋結果過多，只顯示前面的部分
+        page_size=page_size,
     )
 
 
@@ -331,78 +896,36 @@ def buyers():
 @login_required
 def buyers_new():
     form = request.form
-    file = request.files.get("photo")   # ⭐ 新增：抓圖片
-
-    name = form.get("name", "").strip()
-    phone = form.get("phone", "").strip()
-    email = form.get("email", "").strip()
-    line_id = form.get("line_id", "").strip()
-    source = form.get("source", "").strip()
-    level = form.get("level", "").strip()
-    intent_type = form.get("intent_type", "").strip()
-    rent_min = form.get("rent_min", "").strip()
-    rent_max = form.get("rent_max", "").strip()
-    budget_min = form.get("budget_min", "").strip()
-    budget_max = form.get("budget_max", "").strip()
-    preferred_areas = form.get("preferred_areas", "").strip()
-    property_type = form.get("property_type", "").strip()
-    room_range = form.get("room_range", "").strip()
-    car_need = form.get("car_need", "").strip()
-    job = form.get("job", "").strip()
-    family_info = form.get("family_info", "").strip()
-    requirement_must = form.get("requirement_must", "").strip()
-    requirement_nice = form.get("requirement_nice", "").strip()
-    other_background = form.get("other_background", "").strip()
-    note = form.get("note", "").strip()
-
-    if not name:
+    files = request.files.getlist("photos")   # ⭐ <input name="photos" multiple>
+
+    data = _collect(form, BUYER_FIELDS)
+
+    if not data["name"]:
         flash("買方姓名必填", "danger")
         return redirect(url_for("buyers"))
 
-    now = datetime.now().isoformat()
-
     # ⭐ 先建立一個空的 document，拿到 id
     doc_ref = db.collection("buyers").document()
     buyer_id = doc_ref.id
 
-    # ⭐ 如果有上傳圖片，就丟到 Storage
-    photo_url = None
-    if file and file.filename:
-        photo_url = upload_image_to_storage(file, folder="buyers", object_id=buyer_id)
-
-    data = {
-        "name": name,
-        "phone": phone,
-        "email": email,
-        "line_id": line_id,
-        "source": source,
-        "level": level,
-        "intent_type": intent_type,
-        "rent_min": rent_min,
-        "rent_max": rent_max,
-        "budget_min": budget_min,
-        "budget_max": budget_max,
-        "preferred_areas": preferred_areas,
-        "property_type": property_type,
-        "room_range": room_range,
-        "car_need": car_need,
-        "job": job,
-        "family_info": family_info,
-        "requirement_must": requirement_must,
-        "requirement_nice": requirement_nice,
-        "other_background": other_background,
-        "note": note,
-        "created_at": now,
-        "created_by_id": session.get("user_id"),
-        "created_by_name": session.get("user_name"),
-    }
+    # ⭐ 圖片先讀進記憶體，寫完 Firestore 再交給背景上傳
+    uploads = read_uploads(files)
 
-    if photo_url:
-        data["photo_url"] = photo_url   # ⭐ 存圖片網址
+    data.update({
+        **_audit_fields("created"),
+        "search_tokens": build_search_tokens(data["name"], data["phone"]),
+    })
+
+    # ⭐ 圖片網址：主要用 photo_urls，photo_url 當第一張給舊版用（背景上傳完才補上）
+    data["photo_urls"] = []
+    data["photo_url"] = ""
+    data["pending_photos"] = len(uploads)
 
     doc_ref.set(data)
+    invalidate_source_options("buyers")
+    start_background_upload(uploads, "buyers", buyer_id)
 
-    flash("已新增買方", "success")
+    flash("已新增買方" + ("（圖片上傳中）" if uploads else ""), "success")
     return redirect(url_for("buyers"))
 
 
@@ -410,21 +933,30 @@ def buyers_new():
 @app.route("/buyers/<buyer_id>")
 @login_required
 def buyer_detail(buyer_id):
-    doc = db.collection("buyers").document(buyer_id).get()
+    # 載入更多：after = 上一批最後一筆追蹤紀錄的文件 id
+    after = request.args.get("after", "").strip()
+
+    # 買方文件與追蹤紀錄互不相依，同時送出兩個查詢
+    f_doc = IO_POOL.submit(db.collection("buyers").document(buyer_id).get)
+    f_followups = IO_POOL.submit(query_followups_page, "buyers", buyer_id, after)
+    doc = f_doc.result()
+    followup_docs = f_followups.result()
+
     if not doc.exists:
         flash("找不到這位買方", "danger")
         return redirect(url_for("buyers"))
 
     buyer = doc_to_dict(doc)
+    followups = [doc_to_dict(f) for f in followup_docs]
+    next_after = followups[-1]["id"] if len(followups) == FOLLOWUP_PAGE_SIZE else None
 
-    # 追蹤紀錄
-    followups_ref = db.collection("buyer_followups").where("buyer_id", "==", buyer_id)
-    followups = [doc_to_dict(f) for f in followups_ref.stream()]
-
-    # 依 contact_time 排序（新到舊）
-    followups.sort(key=lambda x: x.get("contact_time", ""), reverse=True)
-
-    return render_template("buyer_detail.html", buyer=buyer, followups=followups)
+    return render_template(
+        "buyer_detail.html",
+        buyer=buyer,
+        followups=followups,
+        after=after,
+        next_after=next_after,
+    )
 
 
 # ========= 新增買方追蹤紀錄 =========
@@ -440,9 +972,7 @@ def add_buyer_followup(buyer_id):
     if not contact_time:
         contact_time = datetime.now().strftime("%Y-%m-%d %H:%M")
 
-    now = datetime.now().isoformat()
-
-    db.collection("buyer_followups").add(
+    get_followups_ref("buyers", buyer_id).add(
         {
             "buyer_id": buyer_id,
             "contact_time": contact_time,
@@ -450,9 +980,7 @@ def add_buyer_followup(buyer_id):
             "content": content,
             "next_action": next_action,
             "next_contact_date": next_contact_date,
-            "created_at": now,
-            "created_by_id": session.get("user_id"),
-            "created_by_name": session.get("user_name"),
+            **_audit_fields("created"),
         }
     )
 
@@ -478,65 +1006,20 @@ def buyer_edit(buyer_id):
     if request.method == "POST":
         form = request.form
 
+        updated = _collect(form, BUYER_FIELDS)
+
         # ⭐ 必填姓名檢查
-        name = form.get("name", "").strip()
-        if not name:
+        if not updated["name"]:
             flash("姓名為必填", "danger")
             # 更新 buyer 物件，讓表單保留剛剛輸入的東西
-            buyer.update({
-                "name": name,
-                "phone": form.get("phone", "").strip(),
-                "email": form.get("email", "").strip(),
-                "line_id": form.get("line_id", "").strip(),
-                "source": form.get("source", "").strip(),
-                "level": form.get("level", "").strip(),
-                "intent_type": form.get("intent_type", "").strip(),
-                "rent_min": form.get("rent_min", "").strip(),
-                "rent_max": form.get("rent_max", "").strip(),
-                "budget_min": form.get("budget_min", "").strip(),
-                "budget_max": form.get("budget_max", "").strip(),
-                "preferred_areas": form.get("preferred_areas", "").strip(),
-                "property_type": form.get("property_type", "").strip(),
-                "room_range": form.get("room_range", "").strip(),
-                "car_need": form.get("car_need", "").strip(),
-                "job": form.get("job", "").strip(),
-                "family_info": form.get("family_info", "").strip(),
-                "requirement_must": form.get("requirement_must", "").strip(),
-                "requirement_nice": form.get("requirement_nice", "").strip(),
-                "other_background": form.get("other_background", "").strip(),
-                "note": form.get("note", "").strip(),
-                "stage": form.get("stage", "").strip(),
-            })
+            buyer.update(updated)
             return render_template("buyer_edit.html", buyer=buyer)
 
-        # ✅ 先處理一般文字欄位
-        updated = {
-            "name": name,
-            "phone": form.get("phone", "").strip(),
-            "email": form.get("email", "").strip(),
-            "line_id": form.get("line_id", "").strip(),
-            "source": form.get("source", "").strip(),
-            "level": form.get("level", "").strip(),
-            "intent_type": form.get("intent_type", "").strip(),
-            "rent_min": form.get("rent_min", "").strip(),
-            "rent_max": form.get("rent_max", "").strip(),
-            "budget_min": form.get("budget_min", "").strip(),
-            "budget_max": form.get("budget_max", "").strip(),
-            "preferred_areas": form.get("preferred_areas", "").strip(),
-            "property_type": form.get("property_type", "").strip(),
-            "room_range": form.get("room_range", "").strip(),
-            "car_need": form.get("car_need", "").strip(),
-            "job": form.get("job", "").strip(),
-            "family_info": form.get("family_info", "").strip(),
-            "requirement_must": form.get("requirement_must", "").strip(),
-            "requirement_nice": form.get("requirement_nice", "").strip(),
-            "other_background": form.get("other_background", "").strip(),
-            "note": form.get("note", "").strip(),
-            "stage": form.get("stage", "").strip(),  # 接觸/帶看/斡旋/成交
-            "updated_at": datetime.now().isoformat(),
-            "updated_by_id": session.get("user_id"),
-            "updated_by_name": session.get("user_name"),
-        }
+        # ✅ 補上最後編輯時間 / 編輯者
+        updated.update({
+            **_audit_fields("updated"),
+            "search_tokens": build_search_tokens(updated["name"], updated["phone"]),
+        })
 
         # ====== 圖片處理：多張刪除 + 多張新增 ======
 
@@ -566,29 +1049,41 @@ def buyer_edit(buyer_id):
             if i not in delete_indexes
         ]
 
-        # 2️⃣ 多張上傳：input name="photos" multiple
-        files = request.files.getlist("photos")
-        for f in files:
-            if f and f.filename:
-                photo_url = upload_image_to_storage(f, folder="buyers", object_id=buyer_id)
-                if photo_url:
-                    new_photos.append(photo_url)
-
-        # 3️⃣ 寫回 Firestore：主要用 photo_urls，photo_url 當第一張給舊版用
-        updated["photo_urls"] = new_photos
-        if new_photos:
-            updated["photo_url"] = new_photos[0]
-        else:
-            updated["photo_url"] = ""
-
-        # ✅ 先更新 Firestore
-        doc_ref.update(updated)
+        # 2️⃣ 多張上傳：input name="photos" multiple（先讀進記憶體，寫完 Firestore 再背景上傳）
+        uploads = read_uploads(request.files.getlist("photos"))
 
-        # ✅ 再刪除 Firebase Storage 檔案
+        # 3️⃣ 寫回 Firestore：只用 ArrayRemove 拿掉勾選的圖片，不整個覆蓋 photo_urls，
+        #    背景上傳同時補進來的網址才不會被蓋掉；photo_url 是第一張，給舊版用
         if deleted_urls:
-            delete_storage_files(deleted_urls)
-
-        flash("已更新買方資料", "success")
+            updated["photo_urls"] = firestore.ArrayRemove(deleted_urls)
+            if buyer.get("photo_url") in deleted_urls:
+                updated["photo_url"] = new_photos[0] if new_photos else ""
+        if uploads:
+            updated["pending_photos"] = firestore.Increment(len(uploads))
+
+        # ✅ 先更新 Firestore：買方更新 + 編輯紀錄放同一個 batch，一次 commit
+        batch = db.batch()
+        batch.update(doc_ref, updated)
+        # 編輯紀錄要記實際的圖片列表，不是 ArrayRemove
+        diff = build_audit_diff(buyer, {**updated, "photo_urls": new_photos} if deleted_urls else updated)
+        if diff:
+            add_audit_record(batch, "buyer_audit", "buyer_id", buyer_id, diff)
+        # 要刪的圖片先記一筆待刪除標記，跟更新一起 commit
+        pending_ref = add_pending_delete(batch, deleted_urls) if deleted_urls else None
+        try:
+            batch.commit()
+        except NotFound:
+            # 讀取之後、寫入之前被別人刪掉了
+            flash("找不到這位買方", "danger")
+            return redirect(url_for("buyers"))
+
+        # ✅ 再到背景刪除 Firebase Storage 檔案（成功後移除標記），不讓使用者等 Storage
+        if pending_ref:
+            IO_POOL.submit(finish_pending_delete, pending_ref, deleted_urls)
+
+        invalidate_source_options("buyers")
+        start_background_upload(uploads, "buyers", buyer_id)
+        flash("已更新買方資料" + ("（圖片上傳中）" if uploads else ""), "success")
         return redirect(url_for("buyer_detail", buyer_id=buyer_id))
 
     # GET：第一次進來編輯頁
@@ -598,10 +1093,10 @@ def buyer_edit(buyer_id):
 @app.route("/buyers/<buyer_id>/delete", methods=["POST"])
 @login_required
 def buyer_delete(buyer_id):
-    # 先刪除追蹤紀錄
-    delete_by_field("buyer_followups", "buyer_id", buyer_id)
-    # 再刪除買方本身
-    db.collection("buyers").document(buyer_id).delete()
+    # 買方本身連同 followups subcollection 一起刪除，再清掉 Storage 裡的圖片
+    db.recursive_delete(db.collection("buyers").document(buyer_id))
+    delete_image_from_storage("buyers", buyer_id)
+    invalidate_source_options("buyers")
 
     flash("已刪除買方與相關追蹤紀錄", "info")
     return redirect(url_for("buyers"))
@@ -611,14 +1106,9 @@ def buyer_delete(buyer_id):
 @app.route("/buyers/<buyer_id>/followup/<followup_id>/edit", methods=["GET", "POST"])
 @login_required
 def buyer_followup_edit(buyer_id, followup_id):
-    doc_ref = db.collection("buyer_followups").document(followup_id)
-    doc = doc_ref.get()
-    if not doc.exists:
-        flash("找不到這筆追蹤紀錄", "danger")
-        return redirect(url_for("buyer_detail", buyer_id=buyer_id))
-
-    followup = doc_to_dict(doc)
+    doc_ref = get_followups_ref("buyers", buyer_id).document(followup_id)
 
+    # POST 不先讀文件：update() 找不到文件時本身就會丟 NotFound
     if request.method == "POST":
         contact_time = request.form.get("contact_time", "").strip()
         channel = request.form.get("channel", "").strip()
@@ -629,19 +1119,30 @@ def buyer_followup_edit(buyer_id, followup_id):
         if not contact_time:
             contact_time = datetime.now().strftime("%Y-%m-%d %H:%M")
 
-        doc_ref.update(
-            {
-                "contact_time": contact_time,
-                "channel": channel,
-                "content": content,
-                "next_action": next_action,
-                "next_contact_date": next_contact_date,
-            }
-        )
+        try:
+            doc_ref.update(
+                {
+                    "contact_time": contact_time,
+                    "channel": channel,
+                    "content": content,
+                    "next_action": next_action,
+                    "next_contact_date": next_contact_date,
+                }
+            )
+        except NotFound:
+            flash("找不到這筆追蹤紀錄", "danger")
+            return redirect(url_for("buyer_detail", buyer_id=buyer_id))
 
         flash("已更新追蹤紀錄", "success")
         return redirect(url_for("buyer_detail", buyer_id=buyer_id))
 
+    # GET：需要原本的資料來填表單
+    doc = doc_ref.get()
+    if not doc.exists:
+        flash("找不到這筆追蹤紀錄", "danger")
+        return redirect(url_for("buyer_detail", buyer_id=buyer_id))
+
+    followup = doc_to_dict(doc)
     return render_template("buyer_followup_edit.html", buyer_id=buyer_id, followup=followup)
 
 
@@ -649,7 +1150,7 @@ def buyer_followup_edit(buyer_id, followup_id):
 @app.route("/buyers/<buyer_id>/followup/<followup_id>/delete", methods=["POST"])
 @login_required
 def buyer_followup_delete(buyer_id, followup_id):
-    db.collection("buyer_followups").document(followup_id).delete()
+    get_followups_ref("buyers", buyer_id).document(followup_id).delete()
     flash("已刪除追蹤紀錄", "info")
     return redirect(url_for("buyer_detail", buyer_id=buyer_id))
 
@@ -665,58 +1166,28 @@ def sellers():
     stage = request.args.get("stage", "").strip()      # 進程：開發中 / 委託中 / 成交
     source = request.args.get("source", "").strip()    # 開發來源 / 客戶來源（下拉選單）
     sort_by = request.args.get("sort_by", "created_at_desc")
+    cursor = request.args.get("cursor", "").strip()   # 上一頁最後一筆的 id
+    page_size = parse_page_size(request.args.get("page_size"))
+
+    # ⭐ 等級 / 進程 / 來源都是完全比對，直接交給 Firestore 查詢（走索引）
+    filters = (
+        ("level", level),
+        ("stage", stage),
+        ("source", source),          # 下拉選單，完全比對
+    )
+    try:
+        sellers_list, next_cursor, total, truncated = query_list_page(
+            "sellers", SELLER_LIST_FIELDS, filters, q, sort_by, cursor, page_size
+        )
+    except InvalidCursor:
+        # 分頁資訊失效：其他條件不變，明確回到第一頁
+        flash("分頁資訊已失效，已回到第一頁", "warning")
+        args = request.args.to_dict()
+        args.pop("cursor", None)
+        return redirect(url_for("sellers", **args))
 
-    # 先抓全部賣方
-    docs = db.collection("sellers").stream()
-    all_sellers = [doc_to_dict(d) for d in docs]
-
-    # ⭐ 從現有資料整理出「來源清單」
-    source_set = set()
-    for s in all_sellers:
-        val = (s.get("source") or "").strip()
-        if val:
-            source_set.add(val)
-    source_options = sorted(source_set)
-
-    # 操作中的列表
-    sellers_list = list(all_sellers)
-
-    # ===== 篩選 =====
-
-    # 1️⃣ 關鍵字（姓名 / 電話）
-    if q:
-        sellers_list = [
-            s for s in sellers_list
-            if q in (s.get("name") or "") or q in (s.get("phone") or "")
-        ]
-
-    # 2️⃣ 等級
-    if level:
-        sellers_list = [s for s in sellers_list if s.get("level") == level]
-
-    # 3️⃣ 進程
-    if stage:
-        sellers_list = [s for s in sellers_list if s.get("stage") == stage]
-
-    # 4️⃣ 來源（完全比對，下拉選單）
-    if source:
-        sellers_list = [s for s in sellers_list if (s.get("source") or "") == source]
-
-    # ===== 排序 =====
-    def parse_created_at(s):
-        v = s.get("created_at")
-        if not v:
-            return ""
-        return v
-
-    if sort_by == "created_at_asc":
-        sellers_list.sort(key=parse_created_at)
-    elif sort_by == "created_at_desc":
-        sellers_list.sort(key=parse_created_at, reverse=True)
-    elif sort_by == "name_asc":
-        sellers_list.sort(key=lambda s: (s.get("name") or ""))
-    elif sort_by == "name_desc":
-        sellers_list.sort(key=lambda s: (s.get("name") or ""), reverse=True)
+    # ⭐ 來源清單
+    source_options = get_source_options("sellers")
 
     return render_template(
         "sellers.html",
@@ -727,6 +1198,11 @@ def sellers():
         source=source,                  # 當前選中的來源
         source_options=source_options,  # ⭐ 給模板畫下拉
         sort_by=sort_by,
+        cursor=cursor,
+        next_cursor=next_cursor,
+        total=total,
+        truncated=truncated,          # 搜尋結果過多，只顯示前面的部分
+        page_size=page_size,
     )
 
 
@@ -736,81 +1212,38 @@ def sellers():
 def sellers_new():
     form = request.form
 
-    name = form.get("name", "").strip()
-    phone = form.get("phone", "").strip()
-    email = form.get("email", "").strip()
-    line_id = form.get("line_id", "").strip()
-    address = form.get("address", "").strip()
-    property_type = form.get("property_type", "").strip()
-    level = form.get("level", "").strip()
-    stage = form.get("stage", "").strip()   # 進程
-    reason = form.get("reason", "").strip()
-    expected_price = form.get("expected_price", "").strip()
-    min_price = form.get("min_price", "").strip()
-    timeline = form.get("timeline", "").strip()
-    occupancy_status = form.get("occupancy_status", "").strip()
-    contract_end_date = form.get("contract_end_date", "").strip()
-    note = form.get("note", "").strip()
-
-    # ⭐ 加上“來源 source”
-    source = form.get("source", "").strip()
-
-    if not name:
+    data = _collect(form, SELLER_FIELDS)
+
+    if not data["name"]:
         flash("賣方姓名必填", "danger")
         return redirect(url_for("sellers"))
 
-    now = datetime.now().isoformat()
-
     # 先產生一個 document id → 用來放圖片
     sellers_collection = db.collection("sellers")
     doc_ref = sellers_collection.document()
     seller_id = doc_ref.id
 
-    # ========== 圖片（多張上傳） ==========
-    photo_urls = []
+    # ========== 圖片（多張，寫完 Firestore 再背景上傳） ==========
     files = request.files.getlist("photos")   # <input name="photos" multiple>
-
-    for f in files:
-        if f and f.filename:
-            url = upload_image_to_storage(f, folder="sellers", object_id=seller_id)
-            if url:
-                photo_urls.append(url)
+    uploads = read_uploads(files)
 
     # ========== Firestore 要存的資料 ==========
-    data = {
-        "name": name,
-        "phone": phone,
-        "email": email,
-        "line_id": line_id,
-        "address": address,
-        "property_type": property_type,
-        "level": level,
-        "stage": stage,
-        "reason": reason,
-        "expected_price": expected_price,
-        "min_price": min_price,
-        "timeline": timeline,
-        "occupancy_status": occupancy_status,
-        "contract_end_date": contract_end_date,
-        "note": note,
-        "source": source,               # ⭐ 加進 Firestore
-        "created_at": now,
-        "created_by_id": session.get("user_id"),
-        "created_by_name": session.get("user_name"),
-    }
+    data.update({
+        "search_tokens": build_search_tokens(data["name"], data["phone"]),
+        **_audit_fields("created"),
+    })
 
-    # 如果有圖片就寫入，沒有就給空
-    if photo_urls:
-        data["photo_urls"] = photo_urls
-        data["photo_url"] = photo_urls[0]
-    else:
-        data["photo_urls"] = []
-        data["photo_url"] = ""
+    # 圖片網址等背景上傳完才補上
+    data["photo_urls"] = []
+    data["photo_url"] = ""
+    data["pending_photos"] = len(uploads)
 
     # 寫入 Firestore
     doc_ref.set(data)
+    invalidate_source_options("sellers")
+    start_background_upload(uploads, "sellers", seller_id)
 
-    flash("已新增賣方", "success")
+    flash("已新增賣方" + ("（圖片上傳中）" if uploads else ""), "success")
     return redirect(url_for("sellers"))
 
 
@@ -820,18 +1253,30 @@ def sellers_new():
 @app.route("/sellers/<seller_id>")
 @login_required
 def seller_detail(seller_id):
-    doc = db.collection("sellers").document(seller_id).get()
+    # 載入更多：after = 上一批最後一筆追蹤紀錄的文件 id
+    after = request.args.get("after", "").strip()
+
+    # 賣方文件與追蹤紀錄同時查詢
+    f_doc = IO_POOL.submit(db.collection("sellers").document(seller_id).get)
+    f_followups = IO_POOL.submit(query_followups_page, "sellers", seller_id, after)
+    doc = f_doc.result()
+    followup_docs = f_followups.result()
+
     if not doc.exists:
         flash("找不到這位賣方", "danger")
         return redirect(url_for("sellers"))
 
     seller = doc_to_dict(doc)
+    followups = [doc_to_dict(f) for f in followup_docs]
+    next_after = followups[-1]["id"] if len(followups) == FOLLOWUP_PAGE_SIZE else None
 
-    followups_ref = db.collection("seller_followups").where("seller_id", "==", seller_id)
-    followups = [doc_to_dict(f) for f in followups_ref.stream()]
-    followups.sort(key=lambda x: x.get("contact_time", ""), reverse=True)
-
-    return render_template("seller_detail.html", seller=seller, followups=followups)
+    return render_template(
+        "seller_detail.html",
+        seller=seller,
+        followups=followups,
+        after=after,
+        next_after=next_after,
+    )
 
 
 # ========= 新增賣方追蹤紀錄 =========
@@ -847,9 +1292,7 @@ def add_seller_followup(seller_id):
     if not contact_time:
         contact_time = datetime.now().strftime("%Y-%m-%d %H:%M")
 
-    now = datetime.now().isoformat()
-
-    db.collection("seller_followups").add(
+    get_followups_ref("sellers", seller_id).add(
         {
             "seller_id": seller_id,
             "contact_time": contact_time,
@@ -857,9 +1300,7 @@ def add_seller_followup(seller_id):
             "content": content,
             "next_action": next_action,
             "next_contact_date": next_contact_date,
-            "created_at": now,
-            "created_by_id": session.get("user_id"),
-            "created_by_name": session.get("user_name"),
+            **_audit_fields("created"),
         }
     )
 
@@ -882,28 +1323,11 @@ def seller_edit(seller_id):
     if request.method == "POST":
         form = request.form
 
-        updated = {
-            "name": form.get("name", "").strip(),
-            "phone": form.get("phone", "").strip(),
-            "email": form.get("email", "").strip(),
-            "line_id": form.get("line_id", "").strip(),
-            "address": form.get("address", "").strip(),
-            "property_type": form.get("property_type", "").strip(),
-            "level": form.get("level", "").strip(),
-            "stage": form.get("stage", "").strip(),  # 開發中 / 委託中 / 成交
-            "reason": form.get("reason", "").strip(),
-            "expected_price": form.get("expected_price", "").strip(),
-            "min_price": form.get("min_price", "").strip(),
-            "timeline": form.get("timeline", "").strip(),
-            "occupancy_status": form.get("occupancy_status", "").strip(),
-            "contract_end_date": form.get("contract_end_date", "").strip(),  # 委託到期日
-            "note": form.get("note", "").strip(),
-            # ⭐ 新增：客源來源
-            "source": form.get("source", "").strip(),
-            "updated_at": datetime.now().isoformat(),
-            "updated_by_id": session.get("user_id"),
-            "updated_by_name": session.get("user_name"),
-        }
+        updated = _collect(form, SELLER_FIELDS)
+        updated.update({
+            **_audit_fields("updated"),
+            "search_tokens": build_search_tokens(updated["name"], updated["phone"]),
+        })
 
         # ====== 圖片處理：多張刪除 + 多張新增 ======
 
@@ -921,103 +1345,148 @@ def seller_edit(seller_id):
             except ValueError:
                 pass
 
+        # 勾選刪除的 URL（Firestore 更新完再刪 Storage 檔案）
+        deleted_urls = [
+            url for i, url in enumerate(current_photos)
+            if i in delete_indexes
+        ]
+
         # 把沒勾選的留下來
         new_photos = [
             url for i, url in enumerate(current_photos)
             if i not in delete_indexes
         ]
 
-        # 2️⃣ 多張上傳：input name="photos" multiple
-        files = request.files.getlist("photos")
-        for f in files:
-            if f and f.filename:
-                photo_url = upload_image_to_storage(f, folder="sellers", object_id=seller_id)
-                if photo_url:
-                    new_photos.append(photo_url)
-
-        # 3️⃣ 寫回 Firestore（主要用 photo_urls，photo_url 當第一張方便舊版使用）
-        updated["photo_urls"] = new_photos
-        if new_photos:
-            updated["photo_url"] = new_photos[0]
-        else:
-            updated["photo_url"] = ""
+        # 2️⃣ 多張上傳：input name="photos" multiple（先讀進記憶體，寫完 Firestore 再背景上傳）
+        uploads = read_uploads(request.files.getlist("photos"))
 
-        doc_ref.update(updated)
-        flash("已更新賣方資料", "success")
+        # 3️⃣ 寫回 Firestore：只用 ArrayRemove 拿掉勾選的圖片，不整個覆蓋 photo_urls，
+        #    背景上傳同時補進來的網址才不會被蓋掉；photo_url 是第一張，給舊版用
+        if deleted_urls:
+            updated["photo_urls"] = firestore.ArrayRemove(deleted_urls)
+            if seller.get("photo_url") in deleted_urls:
+                updated["photo_url"] = new_photos[0] if new_photos else ""
+        if uploads:
+            updated["pending_photos"] = firestore.Increment(len(uploads))
+
+        # 賣方更新 + 編輯紀錄放同一個 batch，一次 commit
+        batch = db.batch()
+        batch.update(doc_ref, updated)
+        # 編輯紀錄要記實際的圖片列表，不是 ArrayRemove
+        diff = build_audit_diff(seller, {**updated, "photo_urls": new_photos} if deleted_urls else updated)
+        if diff:
+            add_audit_record(batch, "seller_audit", "seller_id", seller_id, diff)
+        # 要刪的圖片先記一筆待刪除標記，跟更新一起 commit
+        pending_ref = add_pending_delete(batch, deleted_urls) if deleted_urls else None
+        try:
+            batch.commit()
+        except NotFound:
+            # 讀取之後、寫入之前被別人刪掉了
+            flash("找不到這位賣方", "danger")
+            return redirect(url_for("sellers"))
+
+        # 再到背景刪除 Firebase Storage 檔案（成功後移除標記），不讓使用者等 Storage
+        if pending_ref:
+            IO_POOL.submit(finish_pending_delete, pending_ref, deleted_urls)
+
+        invalidate_source_options("sellers")
+        start_background_upload(uploads, "sellers", seller_id)
+        flash("已更新賣方資料" + ("（圖片上傳中）" if uploads else ""), "success")
         return redirect(url_for("seller_detail", seller_id=seller_id))
 
     # GET：首次載入編輯頁
     return render_template("seller_edit.html", seller=seller)
 
 
-def delete_storage_file_by_url(url: str):
+# Storage 網址的開頭；其他網址（例如使用者貼的外部連結）直接略過，不用解析
+_STORAGE_URL_PREFIXES = (
+    "gs://",
+    "https://firebasestorage.googleapis.com/",
+    "https://storage.googleapis.com/",
+)
+
+# 三種 Storage 網址格式一次比對（query string 不算在 path 裡）
+_STORAGE_URL_RE = re.compile(
+    r"^(?:gs://(?P<gs_bucket>[^/]+)/(?P<gs_path>.+)"
+    r"|https://firebasestorage\.googleapis\.com/v0/b/(?P<fb_bucket>[^/]+)/o/(?P<fb_path>[^?#]+)"
+    r"|https://storage\.googleapis\.com/(?P<gcs_bucket>[^/]+)/(?P<gcs_path>[^?#]+))"
+)
+
+
+def _parse_storage_url(url: str):
     """
-    傳入 Firebase Storage 的檔案 URL（支援三種常見格式）：
+    把 Firebase Storage 的檔案 URL 拆成 (bucket 名稱, blob path)，支援三種常見格式：
     1) https://firebasestorage.googleapis.com/v0/b/<bucket>/o/<encoded_path>?...
     2) https://storage.googleapis.com/<bucket>/<path>
     3) gs://<bucket>/<path>
-    自動解析出 bucket 與 blob path 並刪除。
+    bucket 名稱是 None 表示用預設 bucket；解析不了回傳 None
     """
-    if not url:
-        return
+    m = _STORAGE_URL_RE.match(url or "")
+    if not m:
+        return None
 
-    try:
-        bucket = None
-        blob_path = None
+    if m["gs_path"]:
+        return m["gs_bucket"], m["gs_path"]
+    if m["fb_path"]:
+        # firebasestorage 的網址通常用預設 bucket 即可
+        return None, unquote(m["fb_path"])          # buyers%2Fabc%2Fxxx.jpg → buyers/abc/xxx.jpg
+    return m["gcs_bucket"], unquote(m["gcs_path"])
 
-        # --- 格式 3：gs://bucket/path/to/file ---
-        if url.startswith("gs://"):
-            no_scheme = url[len("gs://"):]      # bucket/path/to/file
-            parts = no_scheme.split("/", 1)
-            bucket_name = parts[0]
-            blob_path = parts[1] if len(parts) > 1 else ""
-            bucket = storage.bucket(bucket_name)
 
-        else:
-            parsed = urlparse(url)
-            netloc = parsed.netloc
-            path = parsed.path  # e.g. /team-me-98acf.firebassestorage.app/sellers/xxx.jpg
-
-            # --- 格式 1：firebasestorage.googleapis.com/v0/b/<bucket>/o/<encoded_path> ---
-            if "firebasestorage.googleapis.com" in netloc and "/o/" in path:
-                # 通常用預設 bucket 即可
-                bucket = storage.bucket()
-                encoded_blob_path = path.split("/o/", 1)[1]   # buyers%2Fabc%2Fxxx.jpg
-                blob_path = unquote(encoded_blob_path)        # buyers/abc/xxx.jpg
-
-            # --- 格式 2：storage.googleapis.com/<bucket>/<path> ---
-            elif "storage.googleapis.com" in netloc:
-                # path: /<bucket>/<blob_path>
-                segments = path.lstrip("/").split("/", 1)
-                if len(segments) == 2:
-                    bucket_name, blob_path = segments
-                    bucket = storage.bucket(bucket_name)
-
-        if not bucket or not blob_path:
+def delete_storage_files(urls: list) -> bool:
+    """
+    一次刪多個 URL 對應的 Storage 檔案：先依 bucket 分組，每組用 delete_blobs_batched 打包刪除
+    全部成功回傳 True；有任何檔案刪除失敗回傳 False（之後可以再重試）
+    """
+    ok = True
+    by_bucket = {}
+    for url in urls:
+        if not url or not url.startswith(_STORAGE_URL_PREFIXES):
+            continue
+        parsed = _parse_storage_url(url)
+        if not parsed:
             print("⚠️ 無法解析 Storage URL：", url)
-            return
+            continue
+        bucket_name, blob_path = parsed
+        by_bucket.setdefault(bucket_name, []).append(blob_path)
 
-        blob = bucket.blob(blob_path)
-        if blob.exists():
-            blob.delete()
-            print(f"🔥 已刪除 Storage 檔案：{bucket.name}/{blob_path}")
-        else:
-            print(f"⚠️ 找不到 Storage 檔案：{bucket.name}/{blob_path}")
+    for bucket_name, paths in by_bucket.items():
+        try:
+            if not delete_blobs_batched(_get_bucket(bucket_name), paths):
+                ok = False
+        except Exception as e:
+            print("⚠️ 刪除 Storage 檔案發生錯誤：", e)
+            ok = False
+    return ok
 
-    except Exception as e:
-        print("⚠️ 刪除 Storage 檔案發生錯誤：", e)
+
+# ========= 待刪除圖片標記 =========
+# 先在 Firestore 記下「這些 Storage 檔案要刪」，刪完再把標記拿掉；
+# 中途失敗或程式掛掉，標記會留著，之後用 reap-pending-deletes 補刪，不會留下孤兒檔案
+PENDING_DELETES = "_pending_deletes"
+
+
+def add_pending_delete(batch, urls: list):
+    """把待刪除的 URL 清單寫進 batch（跟資料更新一起 commit），回傳標記的 DocumentReference"""
+    ref = db.collection(PENDING_DELETES).document()
+    batch.set(ref, {"urls": urls, "created_at": firestore.SERVER_TIMESTAMP})
+    return ref
+
+
+def finish_pending_delete(ref, urls: list):
+    """刪除 Storage 檔案，全部成功才移除標記"""
+    if delete_storage_files(urls):
+        ref.delete()
 
 
-def delete_storage_files(urls: list):
-    """一次刪多個 URL 對應的 Storage 檔案"""
-    for url in urls:
-        delete_storage_file_by_url(url)
 # ========= 刪除賣方（含追蹤） =========
 @app.route("/sellers/<seller_id>/delete", methods=["POST"])
 @login_required
 def seller_delete(seller_id):
-    delete_by_field("seller_followups", "seller_id", seller_id)
-    db.collection("sellers").document(seller_id).delete()
+    # 賣方本身連同 followups subcollection 一起刪除，再清掉 Storage 裡的圖片
+    db.recursive_delete(db.collection("sellers").document(seller_id))
+    delete_image_from_storage("sellers", seller_id)
+    invalidate_source_options("sellers")
 
     flash("已刪除賣方與相關追蹤紀錄", "info")
     return redirect(url_for("sellers"))
@@ -1027,14 +1496,9 @@ def seller_delete(seller_id):
 @app.route("/sellers/<seller_id>/followup/<followup_id>/edit", methods=["GET", "POST"])
 @login_required
 def seller_followup_edit(seller_id, followup_id):
-    doc_ref = db.collection("seller_followups").document(followup_id)
-    doc = doc_ref.get()
-    if not doc.exists:
-        flash("找不到這筆追蹤紀錄", "danger")
-        return redirect(url_for("seller_detail", seller_id=seller_id))
-
-    followup = doc_to_dict(doc)
+    doc_ref = get_followups_ref("sellers", seller_id).document(followup_id)
 
+    # POST 不先讀文件：update() 找不到文件時本身就會丟 NotFound
     if request.method == "POST":
         contact_time = request.form.get("contact_time", "").strip()
         channel = request.form.get("channel", "").strip()
@@ -1045,19 +1509,30 @@ def seller_followup_edit(seller_id, followup_id):
         if not contact_time:
             contact_time = datetime.now().strftime("%Y-%m-%d %H:%M")
 
-        doc_ref.update(
-            {
-                "contact_time": contact_time,
-                "channel": channel,
-                "content": content,
-                "next_action": next_action,
-                "next_contact_date": next_contact_date,
-            }
-        )
+        try:
+            doc_ref.update(
+                {
+                    "contact_time": contact_time,
+                    "channel": channel,
+                    "content": content,
+                    "next_action": next_action,
+                    "next_contact_date": next_contact_date,
+                }
+            )
+        except NotFound:
+            flash("找不到這筆追蹤紀錄", "danger")
+            return redirect(url_for("seller_detail", seller_id=seller_id))
 
         flash("已更新追蹤紀錄", "success")
         return redirect(url_for("seller_detail", seller_id=seller_id))
 
+    # GET：需要原本的資料來填表單
+    doc = doc_ref.get()
+    if not doc.exists:
+        flash("找不到這筆追蹤紀錄", "danger")
+        return redirect(url_for("seller_detail", seller_id=seller_id))
+
+    followup = doc_to_dict(doc)
     return render_template("seller_followup_edit.html", seller_id=seller_id, followup=followup)
 
 
@@ -1065,163 +1540,276 @@ def seller_followup_edit(seller_id, followup_id):
 @app.route("/sellers/<seller_id>/followup/<followup_id>/delete", methods=["POST"])
 @login_required
 def seller_followup_delete(seller_id, followup_id):
-    db.collection("seller_followups").document(followup_id).delete()
+    get_followups_ref("sellers", seller_id).document(followup_id).delete()
     flash("已刪除追蹤紀錄", "info")
     return redirect(url_for("seller_detail", seller_id=seller_id))
 
 
+# ========= 賣方追蹤紀錄：批次編輯（JSON） =========
+FOLLOWUP_EDIT_FIELDS = ("contact_time", "channel", "content", "next_action", "next_contact_date")
+FOLLOWUP_BULK_LIMIT = 500  # 一個 batch 最多 500 筆寫入
+
+
+@app.route("/sellers/<seller_id>/followup/bulk_edit", methods=["POST"])
+@login_required
+def seller_followup_bulk_edit(seller_id):
+    """
+    一次更新多筆追蹤紀錄，body 是 JSON：[{"id": "...", "fields": {"content": "...", ...}}, ...]
+    get_all 一次確認全部都在，再用一個 batch 一起寫入（讀、寫各一次來回）
+    """
+    items = request.get_json(silent=True)
+    if not isinstance(items, list) or not items:
+        return jsonify({"error": "需要追蹤紀錄清單"}), 400
+    if len(items) > FOLLOWUP_BULK_LIMIT:
+        return jsonify({"error": f"一次最多 {FOLLOWUP_BULK_LIMIT} 筆"}), 400
+
+    if not is_plain_doc_id(seller_id):
+        return jsonify({"error": "格式錯誤"}), 400
+
+    followups_ref = get_followups_ref("sellers", seller_id)
+    updates = {}
+    for item in items:
+        if (
+            not isinstance(item, dict)
+            or not isinstance(item.get("fields"), dict)
+            or not is_plain_doc_id(item.get("id"))
+        ):
+            return jsonify({"error": "格式錯誤"}), 400
+        # 只接受表單上有的欄位，其他的略過；值要是字串，null 表示刪掉這個欄位
+        fields = {}
+        for k, v in item["fields"].items():
+            if k not in FOLLOWUP_EDIT_FIELDS:
+                continue
+            if v is None:
+                fields[k] = firestore.DELETE_FIELD
+            elif isinstance(v, str):
+                fields[k] = v.strip()
+            else:
+                return jsonify({"error": f"{k} 必須是字串或 null"}), 400
+        if fields:
+            updates[item["id"]] = fields
+
+    if not updates:
+        return jsonify({"updated": 0})
+
+    refs = [followups_ref.document(i) for i in updates]
+    # field_paths=[]：只確認文件存在，不用把內容傳回來
+    missing = [snap.id for snap in db.get_all(refs, field_paths=[]) if not snap.exists]
+    if missing:
+        return jsonify({"error": "找不到這些追蹤紀錄", "missing": missing}), 404
+
+    batch = db.batch()
+    for ref in refs:
+        batch.update(ref, updates[ref.id])
+    try:
+        batch.commit()
+    except NotFound:
+        # 檢查之後、寫入之前被別人刪掉了；batch 不會寫入任何一筆
+        return jsonify({"error": "找不到部分追蹤紀錄"}), 404
+
+    return jsonify({"updated": len(refs)})
+
+
+# ========= CSV 下載共用 =========
+EXPORT_BATCH_SIZE = 500  # 匯出時每次向 Firestore 讀幾筆
+
+
+def stream_in_batches(query, batch_size: int = EXPORT_BATCH_SIZE) -> Iterator:
+    """依文件 id 排序、每次讀 batch_size 筆，再用 cursor 接著讀下一批
+    資料量大時不會因為單一 stream 開太久而逾時，記憶體也只放一批"""
+    yield from _stream_pages(query.order_by("__name__"), batch_size)
+
+
+def _stream_pages(query, batch_size: int) -> Iterator:
+    """query 已經依文件 id 排序；start_after 只換掉起點，原本的終點（end_at）會保留"""
+    query = query.limit(batch_size)
+    last = None
+    while True:
+        page = query.start_after(last) if last is not None else query
+        docs = list(page.stream())
+        yield from docs
+        if len(docs) < batch_size:
+            break
+        last = docs[-1]
+
+
+EXPORT_PARTITIONS = 4  # 大量匯出時同時讀幾段
+# 匯出用自己的執行緒池：下載很慢時執行緒會一直卡著，不能佔用詳細頁也在用的 IO_POOL；
+# 同時超過 2 個匯出時，後面的會等前面的段落讀完
+EXPORT_POOL = ThreadPoolExecutor(EXPORT_PARTITIONS * 2, "export")
+
+
+def stream_partitioned(collection: str, fields: list, partitions: int = EXPORT_PARTITIONS) -> Iterator:
+    """
+    用 get_partitions 依文件 id 把 collection 切成幾段，交給 EXPORT_POOL 同時讀，
+    每段一樣每次讀 EXPORT_BATCH_SIZE 筆，讀到的文件依完成順序交出來（CSV 不需要固定順序）。
+    資料少時 Firestore 只會切成一段，就照原本分批讀。
+    注意：collection group 會包含所有同名的 collection，這裡的名稱只用在最上層
+    """
+    parts = list(db.collection_group(collection).get_partitions(partitions))
+    if len(parts) <= 1:
+        yield from stream_in_batches(db.collection(collection).select(fields))
+        return
+
+    out = queue.Queue(maxsize=EXPORT_BATCH_SIZE)
+    stop = threading.Event()  # 下載中斷時通知還在讀的執行緒停下來
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                out.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def worker(part):
+        try:
+            # partition 的 query 已經依文件 id 排序、設好起訖點，但不會保留 select
+            for d in _stream_pages(part.query().select(fields), EXPORT_BATCH_SIZE):
+                if stop.is_set():
+                    return
+                put(d)
+        except Exception as e:
+            put(e)
+        finally:
+            put(None)  # 這一段讀完了
+
+    for part in parts:
+        EXPORT_POOL.submit(worker, part)
+
+    remaining = len(parts)
+    try:
+        while remaining:
+            item = out.get()
+            if item is None:
+                remaining -= 1
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                yield item
+    finally:
+        stop.set()
+
+
+class Echo:
+    """假的檔案物件：write 直接回傳字串，csv writer 的 writerow 就會回傳這一列的文字"""
+
+    def write(self, value: str) -> str:
+        return value
+
+
+def csv_rows(columns: dict, docs: Iterable) -> Iterator[str]:
+    """
+    產生整份 CSV：BOM → 表頭 → 每份文件一列，每寫一列就送出去，不把整份 CSV 放在記憶體。
+    columns 是 欄位 → 表頭；DictWriter 缺的欄位補空字串，多的欄位略過。
+    writer 每次下載各自建立：C 實作的 writer 有內部緩衝區，多個執行緒共用會寫出錯亂的列
+    """
+    yield '\ufeff'  # UTF-8 BOM，讓 Excel 顯示中文不亂碼
+    writer = csv.DictWriter(Echo(), fieldnames=list(columns), restval="", extrasaction="ignore")
+    yield writer.writerow(columns)
+    for d in docs:
+        yield writer.writerow(doc_to_dict(d))
+
+
+def gzip_stream(chunks: Iterable[str]) -> Iterator[bytes]:
+    """把一段段的文字壓成 gzip 串流，邊產生邊送，不用整份放在記憶體"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31：gzip 格式
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode("utf-8"))
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def csv_response(chunks: Iterable[str], filename: str) -> Response:
+    """CSV 下載回應：瀏覽器支援 gzip 就壓縮後再送（CSV 通常可以壓到 1/10）"""
+    # stream_with_context：產生 CSV 的過程中 request / session 都還在，產生器裡也能用
+    if "gzip" in request.accept_encodings:
+        response = Response(stream_with_context(gzip_stream(chunks)), mimetype="text/csv; charset=utf-8")
+        response.headers["Content-Encoding"] = "gzip"
+    else:
+        response = Response(stream_with_context(chunks), mimetype="text/csv; charset=utf-8")
+    response.headers["Vary"] = "Accept-Encoding"
+    response.headers["Content-Disposition"] = f"attachment; filename={filename}"
+    return response
 
 
 # ========= CSV：賣方 =========
+# CSV 欄位 → 表頭（有進程 + 委託到期日）
+SELLER_CSV_COLUMNS = {
+    "id": "id",
+    "name": "姓名",
+    "phone": "電話",
+    "email": "Email",
+    "line_id": "LINE ID",
+    "address": "物件地址",
+    "property_type": "產品類型",
+    "level": "客戶等級",
+    "stage": "進程",                      # 開發中 / 委託中 / 成交
+    "reason": "出售原因",
+    "expected_price": "期望售價(萬)",
+    "min_price": "可接受底價(萬)",
+    "timeline": "預計出售時程",
+    "occupancy_status": "目前使用狀態",
+    "contract_end_date": "委託到期日",
+    "note": "內部備註",
+    "created_at": "建立時間",
+    "created_by_name": "建立者",
+    "updated_at": "最後編輯時間",
+    "updated_by_name": "最後編輯者",
+}
+# Firestore select 用的欄位（id 不是欄位）
+SELLER_CSV_SELECT = [k for k in SELLER_CSV_COLUMNS if k != "id"]
+
+
 @app.route("/sellers/download")
 @login_required
 def download_sellers():
-    # 從 Firestore 抓全部賣方資料
-    docs = db.collection("sellers").stream()
-    sellers_list = [doc_to_dict(d) for d in docs]
-
-    si = StringIO()
-    writer = csv.writer(si)
-
-    # 表頭（有進程 + 委託到期日）
-    writer.writerow([
-        "id",
-        "姓名",
-        "電話",
-        "Email",
-        "LINE ID",
-        "物件地址",
-        "產品類型",
-        "客戶等級",
-        "進程",              # 開發中 / 委託中 / 成交
-        "出售原因",
-        "期望售價(萬)",
-        "可接受底價(萬)",
-        "預計出售時程",
-        "目前使用狀態",
-        "委託到期日",
-        "內部備註",
-        "建立時間",
-        "建立者",
-        "最後編輯時間",
-        "最後編輯者",
-    ])
-
-    for s in sellers_list:
-        writer.writerow([
-            s.get("id", ""),
-            s.get("name", ""),
-            s.get("phone", ""),
-            s.get("email", ""),
-            s.get("line_id", ""),
-            s.get("address", ""),
-            s.get("property_type", ""),
-            s.get("level", ""),
-            s.get("stage", ""),                # 開發中 / 委託中 / 成交
-            s.get("reason", ""),
-            s.get("expected_price", ""),
-            s.get("min_price", ""),
-            s.get("timeline", ""),
-            s.get("occupancy_status", ""),
-            s.get("contract_end_date", ""),    # 委託到期日
-            s.get("note", ""),
-            s.get("created_at", ""),
-            s.get("created_by_name", ""),
-            s.get("updated_at", ""),
-            s.get("updated_by_name", ""),
-        ])
-
-    csv_data = si.getvalue()
-    csv_data = '\ufeff' + csv_data  # UTF-8 BOM
-
-    filename = f"sellers.csv"
-    response = Response(csv_data, mimetype="text/csv; charset=utf-8")
-    response.headers["Content-Disposition"] = f"attachment; filename={filename}"
-    return response
+    # 從 Firestore 分段同時讀取賣方資料，只抓 CSV 需要的欄位
+    docs = stream_partitioned("sellers", SELLER_CSV_SELECT)
+    return csv_response(csv_rows(SELLER_CSV_COLUMNS, docs), "sellers.csv")
 
 # ========= CSV：買方 =========
+# CSV 欄位 → 表頭（你可以自行調整順序 / 欄位）
+BUYER_CSV_COLUMNS = {
+    "id": "id",
+    "name": "姓名",
+    "phone": "電話",
+    "email": "Email",
+    "line_id": "LINE ID",
+    "source": "客源來源",
+    "level": "客戶等級",
+    "stage": "進程",                      # 接觸 / 帶看 / 斡旋 / 成交
+    "intent_type": "需求類型",            # 原始值（buy/rent/both）
+    "budget_min": "預算最低(萬)",
+    "budget_max": "預算最高(萬)",
+    "rent_min": "租金最低",
+    "rent_max": "租金最高",
+    "preferred_areas": "偏好區域",
+    "property_type": "產品類型",
+    "room_range": "房數需求",
+    "car_need": "車位需求",
+    "job": "職業/收入",
+    "family_info": "家庭成員/生活型態",
+    "requirement_must": "必備條件(Must Have)",
+    "requirement_nice": "加分條件(Nice to Have)",
+    "other_background": "背景補充",
+    "note": "內部備註",
+    "created_at": "建立時間",
+    "created_by_name": "建立者",
+    "updated_at": "最後編輯時間",
+    "updated_by_name": "最後編輯者",
+}
+# Firestore select 用的欄位（id 不是欄位）
+BUYER_CSV_SELECT = [k for k in BUYER_CSV_COLUMNS if k != "id"]
+
+
 @app.route("/buyers/download")
 @login_required
 def download_buyers():
-    # 從 Firestore 抓全部買方資料
-    docs = db.collection("buyers").stream()
-    buyers_list = [doc_to_dict(d) for d in docs]
-
-    # 用 StringIO 暫存 CSV 文字
-    si = StringIO()
-    writer = csv.writer(si)
-
-    # 表頭（你可以自行調整順序 / 欄位）
-    writer.writerow([
-        "id",
-        "姓名",
-        "電話",
-        "Email",
-        "LINE ID",
-        "客源來源",
-        "客戶等級",
-        "進程",          # 接觸 / 帶看 / 斡旋 / 成交
-        "需求類型",      # 買房 / 租屋 / 租買皆可
-        "預算最低(萬)",
-        "預算最高(萬)",
-        "租金最低",
-        "租金最高",
-        "偏好區域",
-        "產品類型",
-        "房數需求",
-        "車位需求",
-        "職業/收入",
-        "家庭成員/生活型態",
-        "必備條件(Must Have)",
-        "加分條件(Nice to Have)",
-        "背景補充",
-        "內部備註",
-        "建立時間",
-        "建立者",
-        "最後編輯時間",
-        "最後編輯者",
-    ])
-
-    for b in buyers_list:
-        writer.writerow([
-            b.get("id", ""),
-            b.get("name", ""),
-            b.get("phone", ""),
-            b.get("email", ""),
-            b.get("line_id", ""),
-            b.get("source", ""),
-            b.get("level", ""),
-            b.get("stage", ""),               # 進程
-            b.get("intent_type", ""),         # 原始值（buy/rent/both），你也可以改成中文後再匯出
-            b.get("budget_min", ""),
-            b.get("budget_max", ""),
-            b.get("rent_min", ""),
-            b.get("rent_max", ""),
-            b.get("preferred_areas", ""),
-            b.get("property_type", ""),
-            b.get("room_range", ""),
-            b.get("car_need", ""),
-            b.get("job", ""),
-            b.get("family_info", ""),
-            b.get("requirement_must", ""),
-            b.get("requirement_nice", ""),
-            b.get("other_background", ""),
-            b.get("note", ""),
-            b.get("created_at", ""),
-            b.get("created_by_name", ""),
-            b.get("updated_at", ""),
-            b.get("updated_by_name", ""),
-        ])
-
-    # 取出 CSV 字串，加上 BOM 讓 Excel 顯示中文不亂碼
-    csv_data = si.getvalue()
-    csv_data = '\ufeff' + csv_data  # UTF-8 BOM
-
-    # 回傳 Response，讓瀏覽器下載
-    filename = f"buyers.csv"
-    response = Response(csv_data, mimetype="text/csv; charset=utf-8")
-    response.headers["Content-Disposition"] = f"attachment; filename={filename}"
-    return response
+    # 從 Firestore 分段同時讀取買方資料，只抓 CSV 需要的欄位
+    docs = stream_partitioned("buyers", BUYER_CSV_SELECT)
+    return csv_response(csv_rows(BUYER_CSV_COLUMNS, docs), "buyers.csv")
 # ========= CLI：建立後台使用者 =========
 @app.cli.command("create-user")
 def create_user_cmd():
@@ -1239,26 +1827,153 @@ def create_user_cmd():
     if not email or not password:
         print("Email / Password 不可空白")
         return
+    if not is_plain_doc_id(email):
+        # email 會拿來當文件 id
+        print("這個 Email 不能當文件 id（不可包含 /，也不能是 . / .. / __xxx__）")
+        return
 
+    # 舊帳號是自動產生的 id，只能用 email 欄位查
     users_ref = db.collection("users").where("email", "==", email).limit(1)
-    docs = list(users_ref.stream())
-    if docs:
+    if next(iter(users_ref.stream()), None) is not None:
         print("此 Email 已存在")
         return
 
-    pwd_hash = generate_password_hash(password)
+    pwd_hash = hash_password(password)
 
-    db.collection("users").add(
-        {
-            "email": email,
-            "name": name or email,
-            "password_hash": pwd_hash,
-            "created_at": datetime.now().isoformat(),
-        }
-    )
+    # 文件 id 直接用 email，登入時讀一份文件就好；
+    # create() 在文件已存在時會失敗，不用先讀一次，也不怕兩個人同時建立
+    try:
+        db.collection("users").document(email).create(
+            {
+                "email": email,
+                "name": name or email,
+                "password_hash": pwd_hash,
+                "created_at": firestore.SERVER_TIMESTAMP,
+            }
+        )
+    except AlreadyExists:
+        print("此 Email 已存在")
+        return
 
     print("使用者建立完成")
 
 
+
+# ========= CLI：追蹤紀錄搬到 subcollection =========
+@app.cli.command("migrate-followups")
+def migrate_followups_cmd():
+    """
+    把舊的 buyer_followups / seller_followups（平的 collection）
+    搬到 buyers/<id>/followups、sellers/<id>/followups：
+      flask --app team_me_firebase.py migrate-followups
+    """
+    for old_collection, parent_collection, parent_field in (
+        ("buyer_followups", "buyers", "buyer_id"),
+        ("seller_followups", "sellers", "seller_id"),
+    ):
+        # 複製跟刪除放在同一個 WriteBatch：要嘛一起成功、要嘛都沒做，
+        # 不會發生新的沒寫進去、舊的卻被刪掉。一個 batch 最多 500 筆寫入 → 250 組
+        batch = db.batch()
+        pending = 0
+        count = 0
+        for d in db.collection(old_collection).stream():
+            data = d.to_dict() or {}
+            parent_id = data.get(parent_field)
+            if not parent_id:
+                print(f"⚠️ {old_collection}/{d.id} 沒有 {parent_field}，略過")
+                continue
+            # 沿用原本的文件 id，編輯 / 刪除的網址不會變
+            batch.set(get_followups_ref(parent_collection, parent_id).document(d.id), data)
+            batch.delete(d.reference)
+            pending += 1
+            if pending == 250:
+                batch.commit()
+                count += pending
+                batch = db.batch()
+                pending = 0
+        if pending:
+            batch.commit()
+            count += pending
+        print(f"{old_collection}：已搬移 {count} 筆")
+
+
+# ========= CLI：補上 search_tokens =========
+@app.cli.command("reindex-search")
+def reindex_search_cmd():
+    """
+    舊資料沒有 search_tokens，列表搜尋會找不到，執行一次補齊：
+      flask --app team_me_firebase.py reindex-search
+    """
+    for collection_name in ("buyers", "sellers"):
+        bw = db.bulk_writer()
+        count = 0
+        for d in db.collection(collection_name).select(["name", "phone"]).stream():
+            data = d.to_dict() or {}
+            bw.update(d.reference, {
+                "search_tokens": build_search_tokens(data.get("name"), data.get("phone")),
+            })
+            count += 1
+        bw.close()
+        print(f"{collection_name}：已更新 {count} 筆")
+
+
+
+# ========= CLI：時間欄位轉成 Timestamp =========
+@app.cli.command("migrate-timestamps")
+def migrate_timestamps_cmd():
+    """
+    把舊資料字串格式的 created_at / updated_at 轉成 Firestore Timestamp，
+    讓列表的 order_by("created_at") 排序正確（字串和 Timestamp 混在一起會分兩段排）：
+      flask --app team_me_firebase.py migrate-timestamps
+    追蹤紀錄的 contact_time 是使用者自己填的，維持字串不動
+    """
+    for label, query in (
+        ("buyers", db.collection("buyers")),
+        ("sellers", db.collection("sellers")),
+        ("followups", db.collection_group("followups")),
+        ("users", db.collection("users")),
+    ):
+        bw = db.bulk_writer()
+        count = 0
+        for d in query.select(["created_at", "updated_at"]).stream():
+            data = d.to_dict() or {}
+            updates = {}
+            for k in ("created_at", "updated_at"):
+                v = data.get(k)
+                if isinstance(v, str) and v:
+                    try:
+                        updates[k] = datetime.fromisoformat(v)
+                    except ValueError:
+                        print(f"⚠️ 無法解析 {d.reference.path} 的 {k}：{v}")
+            if updates:
+                bw.update(d.reference, updates)
+                count += 1
+        bw.close()
+        print(f"{label}：已轉換 {count} 筆")
+
+
+# ========= CLI：補刪待刪除的圖片 =========
+@app.cli.command("reap-pending-deletes")
+def reap_pending_deletes_cmd():
+    """
+    把留下來的待刪除標記（Storage 刪除失敗或程式中途掛掉）重新刪一次，可以排程定期跑：
+      flask --app team_me_firebase.py reap-pending-deletes
+    只處理 10 分鐘以前的標記，避免跟正在進行中的請求搶著刪
+    """
+    cutoff = datetime.now(timezone.utc) - timedelta(minutes=10)
+    done = failed = 0
+    for d in db.collection(PENDING_DELETES).where("created_at", "<", cutoff).stream():
+        urls = (d.to_dict() or {}).get("urls") or []
+        if delete_storage_files(urls):
+            d.reference.delete()
+            done += 1
+        else:
+            failed += 1
+    print(f"已補刪 {done} 筆，失敗 {failed} 筆（下次再試）")
+
+
 if __name__ == "__main__":
+    # 本機開發：模板改了直接重新載入
+    app.config["TEMPLATES_AUTO_RELOAD"] = True
+    app.jinja_env.auto_reload = True
     app.run(debug=True)